@@ -6,6 +6,8 @@ import gevent
 import sys
 
 from worker import Emfas, TwitchSegmentProvider2
+from identification import MoomashAPI, RequestScheduler, \
+    CachingIdentificationService
 
 
 class LevelFilter(logging.Filter):
@@ -47,10 +49,19 @@ def main():
     parser = argparse.ArgumentParser('emfas')
     parser.add_argument('--api-key', required=True, help='moomash api key')
     parser.add_argument('-v', '--verbose', action='count')
+    parser.add_argument('--cache', help='path to a persistent song cache')
     parser.add_argument('url', help='twitch url')
     ns = parser.parse_args()
 
-    emfas = Emfas(ns.api_key)
+    # nobody is waiting for these identifications
+    service = MoomashAPI(ns.api_key, RequestScheduler.BACKGROUND)
+    if ns.cache:
+        # needs numpy, only imported if used
+        from cache import PersistentCache
+        service = CachingIdentificationService(
+            service, PersistentCache(ns.cache)
+        )
+    emfas = Emfas(service)
     sp = TwitchSegmentProvider2(ns.url)
     emfas.start(sp)
 
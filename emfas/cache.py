@@ -0,0 +1,165 @@
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy
+
+import emfas.server.lib.fp
+from emfas.server.lib.codes import as_codes
+
+
+_COMPRESSED_REGEX = re.compile(r'[A-Za-z/\+_\-]')
+
+
+# fixed, so the bands of a code are the same in every process and release
+_MINHASH_SEED = 29
+
+
+def _minhash_params(n):
+    """ `n` multiply-shift hash functions, (a, b) uint64 arrays. """
+    rnd = numpy.random.RandomState(_MINHASH_SEED)
+    halves = rnd.randint(0, 1 << 32, size=(4, n)).astype(numpy.uint64)
+    shift = numpy.uint64(32)
+    a = (halves[0] << shift) | halves[1] | numpy.uint64(1)
+    b = (halves[2] << shift) | halves[3]
+    return a, b
+
+
+def fingerprint_bands(code, bands=16, rows=4):
+    """
+    Locality sensitive keys for an echoprint code, the MinHash signature
+    of its distinct hash codes cut into `bands` bands of `rows` values.
+    Codes sharing most of their hash codes (like overlapping windows of
+    the same stream) very likely have a band in common, unrelated codes
+    almost never. The compression of the code doesn't matter.
+
+    :param code: A compressed or decoded code string
+    :return: A list of `bands` keys or None if the code can't be decoded
+    """
+    if not code:
+        return None
+
+    # compressed codes contain letters, decoded only digits
+    if _COMPRESSED_REGEX.match(code) is not None:
+        code = emfas.server.lib.fp.decode_code_string(code)
+        if not code:
+            return None
+
+    try:
+        distinct = numpy.unique(as_codes(code).codes).astype(numpy.uint64)
+    except ValueError:
+        return None
+    if not len(distinct):
+        return None
+
+    a, b = _minhash_params(bands * rows)
+    # the products wrap around (mod 2 ** 64), the high bits are the hash
+    hashes = (a[:, None] * distinct + b[:, None]) >> numpy.uint64(32)
+    signature = hashes.min(axis=1).astype('<u4').reshape(bands, rows)
+    return [
+        '{0}:{1}'.format(i, hashlib.sha1(band.tostring()).hexdigest())
+        for i, band in enumerate(signature)
+    ]
+
+
+class PersistentCache(object):
+    """
+    A SQLite backed key-value store for JSON serializable values
+    with a TTL and LRU eviction, it never holds more than
+    `max_entries` entries. The database can be shared by all
+    processes on a host.
+    """
+    def __init__(self, path, max_entries=100000, ttl=7*24*60*60):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        # sqlite connections must not be shared across a fork
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.path, timeout=10, check_same_thread=False,
+                isolation_level=None
+            )
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT, '
+                'expires REAL, accessed REAL)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)'
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT value FROM cache WHERE key = ? AND expires > ?',
+                (key, now)
+            ).fetchone()
+            if row is None:
+                return default
+            self.conn.execute(
+                'UPDATE cache SET accessed = ? WHERE key = ?', (now, key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        self.set_many([(key, value)], ttl)
+
+    def set_many(self, items, ttl=None):
+        """ Sets all (key, value) pairs of `items` at once. """
+        if ttl is None:
+            ttl = self.ttl
+
+        now = time.time()
+        rows = [(key, json.dumps(value), now + ttl, now) for key, value in items]
+        with self._lock:
+            # one transaction, so concurrent writers
+            # can't push the cache over max_entries
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', rows
+                )
+                self._evict(now)
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def delete(self, key):
+        with self._lock:
+            self.conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def _evict(self, now):
+        size = self.conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if size <= self.max_entries:
+            return
+        # expired entries go first
+        size -= self.conn.execute('DELETE FROM cache WHERE expires <= ?', (now,)).rowcount
+        if size > self.max_entries:
+            self.conn.execute(
+                'DELETE FROM cache WHERE key IN ('
+                'SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (size - self.max_entries,)
+            )
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -3,9 +3,13 @@ from __future__ import unicode_literals
 import json
 import requests
 import logging
-import worker.server.lib.fp
+import threading
+import time
 
 
+# the fingerprinters, the cache (both need numpy) and ijson are imported
+# by the services using them, MoomashAPI alone doesn't need them
+
 logger = logging.getLogger('emfas')
 
 
@@ -13,7 +17,18 @@ class IdentificationException(Exception):
     pass
 
 
+class RateLimitException(IdentificationException):
+    pass
+
+
+class CircuitOpenException(IdentificationException):
+    pass
+
+
 class MoomashAPIException(IdentificationException):
+    # echonest status code of a quota error
+    RATE_LIMIT_EXCEEDED = 3
+
     def __init__(self, message, code, version):
         IdentificationException.__init__(self, message)
 
@@ -37,16 +52,182 @@ class IdentificationService(object):
         raise NotImplementedError
 
 
+class RequestScheduler(object):
+    """
+    Token bucket shared by all users of a rate limited API.
+
+    Interactive requests wait for the next token, background requests
+    only get a token if more than `reserve` tokens are left (so there
+    is always budget for interactive requests) and are dropped if that
+    does not happen within `background_wait` seconds.
+
+    After `failure_threshold` consecutive failures the circuit opens
+    and all requests fail immediately for `cooldown` seconds, then a
+    single request is let through to probe the API again.
+    """
+    INTERACTIVE, BACKGROUND = range(2)
+
+    def __init__(self, rate=1.0, burst=10, reserve=3, background_wait=5,
+                 interactive_wait=30, failure_threshold=5, cooldown=60):
+        self.rate = float(rate)
+        self.burst = burst
+        self.reserve = reserve
+        self.background_wait = background_wait
+        self.interactive_wait = interactive_wait
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._tokens = float(burst)
+        self._last_refill = time.time()
+        self._interactive_waiting = 0
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last_refill) * self.rate
+        )
+        self._last_refill = now
+
+    def _check_circuit(self, now):
+        """
+        Raises `CircuitOpenException` if the circuit is open, returns
+        True if it is half open and the request would be the probe.
+        """
+        if self._opened_at is None:
+            return False
+        if self._probing or now - self._opened_at < self.cooldown:
+            raise CircuitOpenException(
+                'Circuit open after {0} failures'.format(self._failures)
+            )
+        return True
+
+    def _try_acquire(self, priority):
+        """
+        Takes a token if possible, otherwise returns the
+        time to wait until the next attempt.
+        """
+        with self._lock:
+            now = time.time()
+            probe = self._check_circuit(now)
+            self._refill(now)
+
+            needed = 1
+            if priority == self.BACKGROUND:
+                if self._interactive_waiting:
+                    return 1 / self.rate
+                needed += self.reserve
+
+            if self._tokens >= needed:
+                self._tokens -= 1
+                # half open, only the request which gets
+                # the token probes, all others fail
+                self._probing = probe
+                return 0
+            return (needed - self._tokens) / self.rate
+
+    def _add_interactive_waiting(self, n):
+        with self._lock:
+            self._interactive_waiting += n
+
+    def acquire(self, priority=INTERACTIVE):
+        """
+        Blocks (cooperatively under gevent) until a request may be
+        sent, raises `RateLimitException` if the request has to be
+        dropped and `CircuitOpenException` if the circuit is open.
+
+        Every acquired request has to be reported with `success`
+        or `failure`, otherwise a probe never closes the circuit.
+        """
+        max_wait = self.interactive_wait
+        if priority == self.BACKGROUND:
+            max_wait = self.background_wait
+
+        deadline = time.time() + max_wait
+        wait = self._try_acquire(priority)
+        if not wait:
+            return
+
+        # background requests yield to waiting interactive ones
+        waiting = priority == self.INTERACTIVE
+        if waiting:
+            self._add_interactive_waiting(1)
+        try:
+            while wait:
+                if time.time() + wait > deadline:
+                    raise RateLimitException(
+                        'Request budget exhausted, dropping request'
+                    )
+                time.sleep(wait)
+                wait = self._try_acquire(priority)
+        finally:
+            if waiting:
+                self._add_interactive_waiting(-1)
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self, rate_limited=False):
+        with self._lock:
+            if rate_limited:
+                # the API disagrees with our budget, stop sending for now
+                self._tokens = 0
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                logger.warn('Opening circuit after %s failures', self._failures)
+                self._opened_at = time.time()
+            self._probing = False
+
+
 class MoomashAPI(IdentificationService):
     BASE_URL = 'http://api.mooma.sh/v1'
     HEADERS = {
         'Content-Type': 'application/octet-stream'
     }
 
-    def __init__(self, api_key):
+    # shared by all streams of the process
+    scheduler = RequestScheduler()
+
+    def __init__(self, api_key, priority=RequestScheduler.INTERACTIVE,
+                 scheduler=None):
         self.api_key = api_key
+        self.priority = priority
+        if scheduler is not None:
+            self.scheduler = scheduler
 
     def identify(self, data, buffer_size):
+        self.scheduler.acquire(self.priority)
+        try:
+            j = self._identify(data)
+        except MoomashAPIException as e:
+            self.scheduler.failure(
+                rate_limited=e.code == MoomashAPIException.RATE_LIMIT_EXCEEDED
+            )
+            raise
+        except Exception:
+            # connection errors, but also responses which
+            # aren't the expected JSON, the probe has to end
+            self.scheduler.failure()
+            raise
+        self.scheduler.success()
+
+        # sometimes songs looks like that...
+        # {u'songs': [{}]}
+        songs = [Song.from_json(song) for song in j['response']['songs'] if song]
+        if len(songs) == 0:
+            return None
+        return songs[0]
+
+    def _identify(self, data):
         payload = json.dumps(data)
 
         url = '{0}/song/identify'.format(self.BASE_URL)
@@ -60,23 +241,18 @@ class MoomashAPI(IdentificationService):
         logger.debug('Moomash response: %r', j)
         if not j['response']['status']['code'] == 0:
             raise MoomashAPIException.from_json(j['response']['status'])
-
-        # sometimes songs looks like that...
-        # {u'songs': [{}]}
-        songs = [Song.from_json(song) for song in j['response']['songs'] if song]
-        if len(songs) == 0:
-            return None
-        return songs[0]
+        return j
 
 
 class EchoprintServerAPI(IdentificationService):
     def __init__(self, **kwargs):
-        self.fp = worker.server.lib.fp.FingerPrinter(**kwargs)
+        import emfas.server.lib.fp
+        self.fp = emfas.server.lib.fp.FingerPrinter(**kwargs)
 
     def identify(self, data, buffer_size):
         response = self.fp.best_match_for_query(data['code'])
-        logger.debug('EchoprintServer response, %s in %sms',
-                     response.message(), response.total_time)
+        logger.debug('EchoprintServer response, %s in %sms, %s candidates rescored, stages: %r',
+                     response.message(), response.total_time, response.depth, response.timings)
         if not response.match():
             return None
 
@@ -87,6 +263,64 @@ class EchoprintServerAPI(IdentificationService):
             score=response.score
         )
 
+    def stats(self):
+        """
+        Latency percentiles of the recent identifications
+        per stage, see `emfas.server.lib.fp.FingerPrinter.stats`.
+        """
+        return self.fp.stats()
+
+
+class EmbeddedIdentificationService(EchoprintServerAPI):
+    """
+    Identifies songs against an in-process index, loaded from
+    echoprint JSON dumps (the format `emfas.server fastingest` reads),
+    no Solr or Tokyo Tyrant required.
+    """
+    def __init__(self, *paths):
+        import emfas.server.lib.embedded
+        self.fp = emfas.server.lib.embedded.EmbeddedFingerPrinter()
+        for path in paths:
+            self.load(path)
+
+    def load(self, path):
+        import emfas.server.song
+        from emfas.server.utils import ijson
+
+        with open(path) as f:
+            for item in ijson.items(f, 'item'):
+                song = emfas.server.song.Song.from_echoprint(item)
+                if song is not None:
+                    self.fp.ingest(song.to_dict(), do_commit=False)
+        self.fp.commit()
+        logger.info('Embedded index loaded %s, %s tracks', path, len(self.fp))
+
+
+class CachingIdentificationService(IdentificationService):
+    """
+    Remembers the songs another identification service found in a
+    `emfas.cache.PersistentCache`, by the MinHash bands of the code
+    (see `emfas.cache.fingerprint_bands`). A later code of the same
+    audio is answered from the cache if any of its bands is known.
+    """
+    def __init__(self, service, cache):
+        self.service = service
+        self.cache = cache
+
+    def identify(self, data, buffer_size):
+        import emfas.cache
+        bands = emfas.cache.fingerprint_bands(data.get('code')) or []
+        for band in bands:
+            cached = self.cache.get('fp:' + band)
+            if cached is not None:
+                logger.debug('Cached song for band %s', band)
+                return Song(**cached)
+
+        song = self.service.identify(data, buffer_size)
+        if song is not None:
+            self.cache.set_many(('fp:' + band, song.__dict__) for band in bands)
+        return song
+
 
 class Song(object):
     def __init__(self, id=None, artist_id=None, artist=None, title=None, source=None, score=0):
@@ -3,6 +3,7 @@ import logging
 import itertools
 import datetime
 import signal
+import time
 from emfas.server.utils import (
     ijson, grouper, SimpleJSONArrayWriter, NullWriter, committing
 )
@@ -134,6 +135,97 @@ def size(ns):
     return s
 
 
+def _segmentation_setting(s):
+    try:
+        length, overlap = map(int, s.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('{0!r} is not LENGTH:OVERLAP'.format(s))
+    if not length > overlap >= 0:
+        raise argparse.ArgumentTypeError(
+            '{0!r}: the overlap must be at least 0 and less than the length'.format(s)
+        )
+    return length, overlap
+
+
+def segments(ns):
+    """
+    Reports the index size and recall of segmentation settings
+    (segment length and overlap) on a sample of a json file, using
+    the in-process index. Queries are random excerpts of the sampled
+    tracks with a part of the codes dropped, like a recording.
+
+    :param ns: Namespace object with required config
+    :return: None
+    """
+    import numpy
+    from emfas.server.lib.codes import Codes, as_codes
+    from emfas.server.lib.embedded import EmbeddedFingerPrinter
+
+    rnd = numpy.random.RandomState(ns.seed)
+
+    with open(ns.path) as f:
+        items = itertools.islice(ijson.items(f, 'item'), ns.sample)
+        songs = [song for song in (Song.from_echoprint(item) for item in items)
+                 if song is not None]
+    if not songs:
+        raise ValueError('No fingerprints in {0}'.format(ns.path))
+
+    total = sum(len(as_codes(song.fp)) for song in songs)
+    query_length = ns.query_length * 1000.0 / 23.2
+
+    queries = []
+    for i in rnd.randint(len(songs), size=ns.queries):
+        code = as_codes(songs[i].fp)
+        if not len(code):
+            continue
+        start = rnd.uniform(0, max(int(code.times[-1]) - query_length, 0))
+        excerpt = code.between(start, start + query_length)
+        keep = rnd.random_sample(len(excerpt)) >= ns.noise
+        queries.append((songs[i].track_id, Codes(
+            excerpt.codes[keep], excerpt.times[keep] - int(start), is_sorted=True
+        )))
+
+    print '{0} tracks, {1} codes, {2} queries of {3}s'.format(
+        len(songs), total, len(queries), ns.query_length
+    )
+    print '{0:>7} {1:>8} {2:>12} {3:>6} {4:>7} {5:>9}'.format(
+        'length', 'overlap', 'codes', 'size', 'recall', 'ingest'
+    )
+    for segment_length, segment_overlap in ns.settings:
+        efp = EmbeddedFingerPrinter(segment_length=segment_length,
+                                    segment_overlap=segment_overlap)
+        tic = time.time()
+        for song in songs:
+            efp.ingest(song.to_dict(), do_commit=False, split=True)
+        efp.commit()
+        ingest_time = time.time() - tic
+
+        found = sum(efp.best_match_for_query(code).TRID == track_id
+                    for track_id, code in queries)
+        print '{0:>6}s {1:>7}s {2:>12} {3:>5.2f}x {4:>7.1%} {5:>8.2f}s'.format(
+            segment_length, segment_overlap, efp.size, efp.size / float(total),
+            found / float(len(queries) or 1), ingest_time
+        )
+
+
+def localsolr(ns):
+    """
+    Serves an in-memory stand-in for the echoprint Solr core
+    (/select, /hashq and /update) until interrupted
+
+    :param ns: Namespace object with required config
+    :return: None
+    """
+    from emfas.server.lib.localsolr import LocalSolrServer
+
+    server = LocalSolrServer((ns.host, ns.port))
+    print 'Serving {0}'.format(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
 def main():
     parser = argparse.ArgumentParser('emfas.server')
     parser.add_argument('--solr', default='http://localhost:8502/solr/fp')
@@ -159,6 +251,22 @@ def main():
     size_parser = subparsers.add_parser('size')
     size_parser.add_argument('path')
 
+    segments_parser = subparsers.add_parser('segments')
+    segments_parser.add_argument('--sample', type=int, default=1000)
+    segments_parser.add_argument('--queries', type=int, default=200)
+    segments_parser.add_argument('--query-length', type=int, default=20)
+    segments_parser.add_argument('--noise', type=float, default=0.3)
+    segments_parser.add_argument('--seed', type=int, default=1)
+    segments_parser.add_argument(
+        '--settings', type=_segmentation_setting, nargs='+',
+        default=[(60, 30), (60, 15), (60, 0), (30, 10)]
+    )
+    segments_parser.add_argument('path')
+
+    localsolr_parser = subparsers.add_parser('localsolr')
+    localsolr_parser.add_argument('--host', default='127.0.0.1')
+    localsolr_parser.add_argument('--port', type=int, default=8502)
+
     ns = parser.parse_args()
 
     if ns.verbose:
@@ -169,7 +277,8 @@ def main():
 
     commands = {
         'ingest': ingest, 'fastingest': fastingest,
-        'split': split, 'size': size
+        'split': split, 'size': size, 'segments': segments,
+        'localsolr': localsolr
     }
 
     logging.getLogger(__name__).info('Arguments: {0}'.format(ns))
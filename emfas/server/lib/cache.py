@@ -0,0 +1,89 @@
+"""
+In-process caches for the fingerprinters.
+"""
+import collections
+import threading
+
+
+class LRUCache(object):
+    """ A thread safe dict which drops the least recently used entries once
+        it holds more than `max_size` of them or, if `max_bytes` is set, once
+        their size (as `sizeof` returns it) adds up to more than `max_bytes`.
+        Either limit can be None. """
+    def __init__(self, max_size=10000, max_bytes=None, sizeof=len):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, size)
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # move to the end, the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, size)
+            self.bytes += size
+            while (self.max_size is not None and len(self._data) > self.max_size) or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, size) = self._data.popitem(last=False)
+                self.bytes -= size
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+        return entry
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._pop(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def pop_where(self, predicate):
+        """ Removes all entries whose key matches `predicate`. """
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """ Returns {'entries': n, 'bytes': n, 'hits': n, 'misses': n, 'hit_rate': f} """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / requests if requests else None
+            }
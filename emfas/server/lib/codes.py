@@ -0,0 +1,222 @@
+"""
+NumPy helpers to work with decoded echoprint codes.
+
+A decoded code string is a space separated list of
+`code time code time ...` pairs, these helpers turn it
+into a `Codes` container and score them.
+"""
+import numpy
+
+
+# ASCII value -> value of the hex digit, 255 for non hex characters
+_HEX_DIGITS = numpy.empty(256, dtype=numpy.uint8)
+_HEX_DIGITS.fill(255)
+for _i, _c in enumerate('0123456789abcdef'):
+    _HEX_DIGITS[ord(_c)] = _HEX_DIGITS[ord(_c.upper())] = _i
+
+
+class Codes(object):
+    """ A decoded fingerprint, parallel uint32 arrays of hash codes
+        and their times, always sorted by time.
+
+        Parse a fingerprint once, slicing (`between`, `codes[i:j]`)
+        returns views and never copies or reparses the codes. """
+    def __init__(self, codes, times, is_sorted=False):
+        codes = numpy.asarray(codes, dtype=numpy.uint32)
+        times = numpy.asarray(times, dtype=numpy.uint32)
+        if len(codes) != len(times):
+            raise ValueError('Got {0} codes but {1} times'.format(len(codes), len(times)))
+
+        if not is_sorted and len(times) > 1 and (times[1:] < times[:-1]).any():
+            order = numpy.argsort(times, kind='mergesort')
+            codes, times = codes[order], times[order]
+
+        self.codes = codes
+        self.times = times
+
+    @classmethod
+    def from_string(cls, code_string):
+        """ Parses a decoded code string, `code time code time ...`. """
+        return cls(*parse_code_string(code_string))
+
+    @classmethod
+    def from_hex(cls, s):
+        """ Parses an inflated code string, n 5 digit hex times
+            followed by n 5 digit hex codes. """
+        n = len(s) // 10
+        return cls(parse_hex(s[5 * n:]), parse_hex(s[:5 * n]))
+
+    def to_string(self):
+        """ The decoded code string (wire format of Solr and the keystore). """
+        values = numpy.empty(2 * len(self), dtype=numpy.uint32)
+        values[::2] = self.codes
+        values[1::2] = self.times
+        return ' '.join(map(str, values.tolist()))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Reads what `to_bytes` wrote. """
+        values = numpy.frombuffer(data, dtype='<u4')
+        n = len(values) // 2
+        return cls(values[:n], values[n:], is_sorted=True)
+
+    def to_bytes(self):
+        """ A compact binary form, the codes and times as little endian uint32. """
+        return numpy.concatenate([self.codes, self.times]).astype('<u4').tostring()
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.times.nbytes
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self.codes[item], self.times[item]
+        return Codes(self.codes[item], self.times[item], is_sorted=True)
+
+    def __repr__(self):
+        return '<Codes ({0} codes)>'.format(len(self))
+
+    def between(self, start, end):
+        """ All codes with `start <= time < end`. """
+        i, j = numpy.searchsorted(self.times, [start, end])
+        return self[i:j]
+
+    def windows(self, length, step):
+        """ Yields the codes of the windows `[i * step, i * step + length)`,
+            from time 0 until the window which holds the last code. The
+            window starts and ends are each looked up with one vectorized
+            `searchsorted` call, a binary search per boundary. """
+        if not len(self):
+            return
+
+        starts = numpy.arange(int(self.times[-1] / step) + 1) * step
+        lower = numpy.searchsorted(self.times, starts)
+        upper = numpy.searchsorted(self.times, starts + length)
+        for i, j in zip(lower, upper):
+            yield self[i:j]
+
+    def compile(self, slop=2):
+        return CompiledQuery(self.codes, self.times, slop=slop)
+
+
+def as_codes(code):
+    """ Returns `code` as `Codes`, parsing it if it's a decoded code string. """
+    if isinstance(code, Codes):
+        return code
+    return Codes.from_string(code)
+
+
+def parse_code_string(code_string):
+    """ Parses a decoded code string into two parallel uint32
+        arrays, (codes, times). """
+    tokens = code_string.split()
+    if not tokens:
+        return numpy.zeros(0, dtype=numpy.uint32), numpy.zeros(0, dtype=numpy.uint32)
+    values = numpy.fromstring(code_string, dtype=numpy.uint32, sep=' ')
+    # fromstring silently stops at the first token it can't parse, of
+    # the last token it may have parsed just the digits in front
+    if len(values) != len(tokens) or not tokens[-1].isdigit():
+        raise ValueError('Invalid value in code string')
+    if len(values) % 2:
+        raise ValueError('Code string has an odd number of values')
+    return values[::2].copy(), values[1::2].copy()
+
+
+def parse_hex(s, width=5):
+    """ Parses a string of 0-padded fixed-width hex numbers
+        into an uint32 array, all at once. """
+    if width > 8:
+        raise ValueError('Hex numbers wider than 8 digits don\'t fit uint32')
+    if len(s) % width:
+        raise ValueError('Hex string length is not a multiple of {0}'.format(width))
+
+    digits = _HEX_DIGITS[numpy.frombuffer(s, dtype=numpy.uint8)]
+    if len(digits) and digits.max() > 15:
+        raise ValueError('Invalid hex digit in code string')
+
+    digits = digits.reshape(-1, width)
+    values = digits[:, 0].astype(numpy.uint32)
+    for i in xrange(1, width):
+        values <<= 4
+        values |= digits[:, i]
+    return values
+
+
+def expand_ranges(starts, ends):
+    """ Concatenates the ranges `starts[i]:ends[i]` into a single
+        index array, without a python loop. """
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if not total:
+        return numpy.zeros(0, dtype=numpy.intp)
+    offsets = numpy.cumsum(lengths) - lengths
+    return numpy.repeat(starts - offsets, lengths) + numpy.arange(total)
+
+
+def latest_slots(codes, slots):
+    """ Inverts a query, returns the sorted distinct `codes` and for
+        each of them the latest (biggest) slot it occurs at. """
+    order = numpy.lexsort((slots, codes))
+    codes, slots = codes[order], slots[order]
+    last = numpy.empty(len(codes), dtype=bool)
+    last[:-1] = codes[1:] != codes[:-1]
+    last[-1:] = True
+    return codes[last], slots[last]
+
+
+class CompiledQuery(object):
+    """ A query prepared once to be scored against many candidates.
+
+        Holds the inverted query, its distinct codes (sorted) and for each
+        code the latest time slot (time normalized to start at 0, divided
+        by `slop`) it occurs at. Compared to the latest query time every
+        match code has the minimal time difference `fp.actual_matches` uses. """
+    def __init__(self, codes, times, slop=2):
+        self.slop = slop
+        self.length = len(codes)
+        if self.length:
+            slots = (times.astype(numpy.int64) - times.min()) // slop
+            self.codes, self.latest = latest_slots(codes, slots)
+        else:
+            self.codes = numpy.zeros(0, dtype=numpy.uint32)
+            self.latest = numpy.zeros(0, dtype=numpy.int64)
+
+    @classmethod
+    def from_string(cls, code_string, slop=2):
+        return as_codes(code_string).compile(slop=slop)
+
+    def __len__(self):
+        return self.length
+
+    def offsets(self, match_codes, match_times):
+        """ Time offsets (in slots) of all match codes found in the query. """
+        if not len(self.codes):
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        index = numpy.searchsorted(self.codes, match_codes)
+        index[index == len(self.codes)] = 0
+        found = self.codes[index] == match_codes
+        return match_times[found].astype(numpy.int64) // self.slop - self.latest[index[found]]
+
+    def score(self, match, elbow=10):
+        """ Vectorized `fp.actual_matches` against `Codes`. """
+        match_codes, match_times = match.codes, match.times
+        if len(match_codes) < elbow:
+            return 0
+
+        offsets = self.offsets(match_codes, match_times)
+        return histogram_score(offsets[offsets < 32767])
+
+
+def histogram_score(offsets):
+    """ The "actual score" of `fp.actual_matches`, the sum of
+        the two biggest bins of the time offset histogram. """
+    if not len(offsets):
+        return 0
+    counts = numpy.bincount(offsets - offsets.min())
+    if len(counts) == 1:
+        return int(counts[0])
+    return int(numpy.partition(counts, len(counts) - 2)[-2:].sum())
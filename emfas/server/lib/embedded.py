@@ -0,0 +1,204 @@
+"""
+An in-process fingerprint store, a replacement for Solr and
+Tokyo Tyrant for small and medium sized catalogs.
+
+All codes are kept in one inverted index, three parallel arrays
+sorted by hash code: (code, track, time).
+"""
+import datetime
+import time
+
+import numpy
+
+import fp
+import solr
+import stats
+from codes import as_codes, expand_ranges, histogram_score
+
+
+class EmbeddedFingerPrinter(fp.BaseFingerPrinter):
+    def __init__(self, slop=2, metadata_cache_size=10000, depths=None, segment_length=None, segment_overlap=None):
+        fp.BaseFingerPrinter.__init__(self, metadata_cache_size, depths, segment_length, segment_overlap)
+        self.slop = slop
+        self._clear()
+
+    def _clear(self):
+        self._track_ids = []
+        self._track_index = {}
+        self._metadata = {}
+        # number of codes per track
+        self._lengths = []
+
+        self._codes = numpy.zeros(0, dtype=numpy.uint32)
+        self._tracks = numpy.zeros(0, dtype=numpy.uint32)
+        self._times = numpy.zeros(0, dtype=numpy.uint32)
+
+        # (codes, tracks, times) not yet merged into the index
+        self._pending = []
+        self._deleted = set()
+
+    def __len__(self):
+        return len(self._track_index)
+
+    @property
+    def size(self):
+        """ Number of codes in the index. """
+        return len(self._codes) + sum(len(p[0]) for p in self._pending)
+
+    def metadata_for_track_id(self, track_id, append_end=True):
+        # segments share the metadata of their track
+        return dict(self._metadata.get(track_id.split("-")[0], {}))
+
+    def ingest(self, fingerprint_list, do_commit=True, split=False):
+        """ Ingest fingerprints, see `fp.FingerPrinter.ingest`. Unlike the
+            Solr backed store whole tracks are indexed by default, pass
+            `split=True` to store overlapping segments instead. """
+        if not isinstance(fingerprint_list, list):
+            fingerprint_list = [fingerprint_list]
+
+        for fprint in fingerprint_list:
+            if not ("track_id" in fprint and "fp" in fprint and "length" in fprint and "codever" in fprint):
+                raise ValueError("Missing required fingerprint parameters (track_id, fp, length, codever")
+            if "import_date" not in fprint:
+                fprint["import_date"] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+            if "source" not in fprint:
+                fprint["source"] = "local"
+
+            trid = fprint["track_id"].split("-")[0]
+            metadata = dict((k, fprint.get(k)) for k in fp.METADATA_FIELDS)
+            metadata["track_id"] = trid
+            self._metadata[trid] = metadata
+            self.metadata_cache.pop(trid)
+
+            docs = fp.split_codes(fprint, *self.segmentation()) if split else [fprint]
+            for doc in docs:
+                self._add(doc["track_id"], doc["fp"])
+
+        if do_commit:
+            self.commit()
+
+    def _add(self, track_id, code):
+        if track_id in self._track_index:
+            self._deleted.add(self._track_index[track_id])
+
+        code = as_codes(code)
+        codes, times = code.codes, code.times
+        index = len(self._track_ids)
+        self._track_ids.append(track_id)
+        self._track_index[track_id] = index
+        self._lengths.append(len(codes))
+
+        tracks = numpy.empty(len(codes), dtype=numpy.uint32)
+        tracks.fill(index)
+        self._pending.append((codes, tracks, times))
+
+    def delete(self, track_ids, do_commit=True):
+        if not isinstance(track_ids, list):
+            track_ids = [track_ids]
+
+        for t in track_ids:
+            self._metadata.pop(t, None)
+            self.metadata_cache.pop(t)
+            # also drops the segments (<id>-0, <id>-1, ...) of the track
+            for track_id in [tid for tid in self._track_index if tid == t or tid.startswith(t + "-")]:
+                self._deleted.add(self._track_index.pop(track_id))
+
+        if do_commit:
+            self.commit()
+
+    def erase_database(self, really_delete=False):
+        if not really_delete:
+            raise Exception("Won't delete unless you pass in really_delete=True")
+
+        self._clear()
+        self.metadata_cache.clear()
+
+    def commit(self):
+        """ Merges all pending changes into the index. """
+        if not self._pending and not self._deleted:
+            return
+
+        codes = numpy.concatenate([self._codes] + [p[0] for p in self._pending])
+        tracks = numpy.concatenate([self._tracks] + [p[1] for p in self._pending])
+        times = numpy.concatenate([self._times] + [p[2] for p in self._pending])
+        self._pending = []
+
+        if self._deleted:
+            keep = ~numpy.in1d(tracks, numpy.fromiter(self._deleted, dtype=numpy.uint32))
+            codes, tracks, times = codes[keep], tracks[keep], times[keep]
+            for t in self._deleted:
+                self._lengths[t] = 0
+            self._deleted = set()
+
+        order = numpy.argsort(codes, kind='mergesort')
+        self._codes = codes[order]
+        self._tracks = tracks[order]
+        self._times = times[order]
+
+    def _postings(self, query_codes):
+        """ Index positions of all postings of the (unique, sorted) `query_codes`
+            and for every posting the position of its code in `query_codes`. """
+        starts = numpy.searchsorted(self._codes, query_codes, side='left')
+        ends = numpy.searchsorted(self._codes, query_codes, side='right')
+        positions = expand_ranges(starts, ends)
+        return positions, numpy.repeat(numpy.arange(len(query_codes)), ends - starts)
+
+    def query_fp(self, code_string, rows=15, get_data=False):
+        """ Scores tracks by the number of distinct query codes they
+            contain (the same score the /hashq handler calculates) and
+            returns the top `rows` as a `solr.Response`. """
+        tic = time.time()
+
+        query_codes = numpy.unique(as_codes(code_string).codes)
+        positions, code_index = self._postings(query_codes)
+
+        # count every (query code, track) pair only once
+        num_tracks = len(self._track_ids)
+        pairs = numpy.unique(code_index * num_tracks + self._tracks[positions])
+        scores = numpy.bincount(pairs % num_tracks, minlength=num_tracks) if len(pairs) else \
+            numpy.zeros(num_tracks, dtype=numpy.intp)
+        top = numpy.argsort(-scores, kind='mergesort')[:rows]
+        top = top[scores[top] > 0]
+
+        results = solr.Results()
+        for t in top:
+            result = {"track_id": self._track_ids[t], "score": int(scores[t])}
+            if get_data:
+                metadata = self.metadata_for_track_id(self._track_ids[t])
+                result.update((k, metadata.get(k)) for k in fp.METADATA_FIELDS if k != "track_id")
+            results.append(result)
+        results.start = 0
+        results.numFound = len(top)
+
+        response = solr.Response(None)
+        response.header = {"QTime": int((time.time() - tic) * 1000)}
+        response.results = results
+        return response
+
+    def actual_scores(self, query, track_ids, elbow=10, timings=None, prefetched=None):
+        """ `fp.actual_matches` for every track, computed on the postings:
+            each document code is matched against the latest query time
+            of the same code, which gives the minimal time difference. """
+        if timings is None:
+            timings = stats.Timings()
+
+        with timings.stage("rescore"):
+            return self._actual_scores(query, track_ids, elbow)
+
+    def _actual_scores(self, query, track_ids, elbow):
+        candidates = dict((track_id, self._track_index[track_id])
+                          for track_id in track_ids if track_id in self._track_index)
+        positions, code_index = self._postings(query.codes)
+        tracks = self._tracks[positions]
+        keep = numpy.in1d(tracks, numpy.fromiter(candidates.values(), dtype=numpy.uint32))
+        tracks = tracks[keep]
+        offsets = self._times[positions[keep]].astype(numpy.int64) // query.slop - query.latest[code_index[keep]]
+
+        scores = {}
+        for track_id, t in candidates.iteritems():
+            if self._lengths[t] < elbow:
+                scores[track_id] = 0
+            else:
+                track_offsets = offsets[tracks == t]
+                scores[track_id] = histogram_score(track_offsets[track_offsets < 32767])
+        return scores
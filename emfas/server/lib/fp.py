@@ -18,9 +18,15 @@ import random
 import string
 import datetime
 import traceback
+import threading
+import itertools
+import Queue
 
 import solr
 import pytyrant
+import stats
+import codes
+import cache
 
 try:
     import json
@@ -28,6 +34,9 @@ except ImportError:
     import simplejson as json
 
 
+# the fields query_fp(..., get_data=True) returns for every candidate
+METADATA_FIELDS = ("track_id", "artist", "release", "track", "length", "source")
+
 _hexpoch = int(time.time() * 1000)
 logger = logging.getLogger(__name__)
 
@@ -37,7 +46,7 @@ class Response(object):
     NOT_ENOUGH_CODE, CANNOT_DECODE, SINGLE_BAD_MATCH, SINGLE_GOOD_MATCH, NO_RESULTS, MULTIPLE_GOOD_MATCH_HISTOGRAM_INCREASED, \
     MULTIPLE_GOOD_MATCH_HISTOGRAM_DECREASED, MULTIPLE_BAD_HISTOGRAM_MATCH, MULTIPLE_GOOD_MATCH = range(9)
 
-    def __init__(self, code, TRID=None, score=0, qtime=0, tic=0, metadata=None):
+    def __init__(self, code, TRID=None, score=0, qtime=0, tic=0, metadata=None, depth=0):
         self.code = code
         self.qtime = qtime
         self.TRID = TRID
@@ -46,6 +55,10 @@ class Response(object):
         self.metadata = metadata
         if self.metadata is None:
             self.metadata = dict()
+        # stage -> ms, set by FingerPrinter.best_match_for_query
+        self.timings = dict()
+        # number of candidates rescored with their codes from the keystore
+        self.depth = depth
 
     def __len__(self):
         if self.TRID is not None:
@@ -70,22 +83,29 @@ class Response(object):
 
 def inflate_code_string(s):
     """ Takes an uncompressed code string consisting of 0-padded fixed-width
-        sorted hex and converts it to the standard code string."""
+        sorted hex and converts it to `codes.Codes`."""
+    return codes.Codes.from_hex(s)
+
+
+def inflate_code_string_python(s):
+    """ The original pure python `inflate_code_string`, kept as reference. """
     n = int(len(s) / 10.0)  # 5 hex bytes for hash, 5 hex bytes for time (40 bits)
 
     # Parse out n groups of 5 timestamps in hex; then n groups of 8 hash codes in hex.
     end_timestamps = n * 5
     times = [int(''.join(t), 16) for t in chunker(s[:end_timestamps], 5)]
-    codes = [int(''.join(t), 16) for t in chunker(s[end_timestamps:], 5)]
+    hash_codes = [int(''.join(t), 16) for t in chunker(s[end_timestamps:], 5)]
 
-    assert (len(times) == len(codes))  # these should match up!
-    return ' '.join('%d %d' % (c, t) for c, t in zip(codes, times))
+    assert (len(times) == len(hash_codes))  # these should match up!
+    return codes.Codes(hash_codes, times)
 
 
 def decode_code_string(compressed_code_string):
+    """ Decodes a compressed code string into `codes.Codes`, returns None
+        if it can't be decoded. """
     compressed_code_string = compressed_code_string.encode('utf8')
     if compressed_code_string == "":
-        return ""
+        return codes.Codes([], [])
     # do the zlib/base64 stuff
     try:
         # this will decode both URL safe b64 and non-url-safe
@@ -94,13 +114,20 @@ def decode_code_string(compressed_code_string):
         logger.warn("Could not decode base64 zlib string %s" % compressed_code_string)
         logger.warn(traceback.format_exc())
         return None
-    # If it is a deflated code, expand it from hex
-    if ' ' not in actual_code:
-        actual_code = inflate_code_string(actual_code)
-    return actual_code
+    try:
+        # If it is a deflated code, expand it from hex
+        if ' ' not in actual_code:
+            return inflate_code_string(actual_code)
+        return codes.Codes.from_string(actual_code)
+    except ValueError as e:
+        logger.warn("Could not parse decompressed code string: %s" % e)
+        return None
 
 
 def encode_code_string(uncompressed_code_string):
+    """ Compresses a decoded code string or `codes.Codes`. """
+    if isinstance(uncompressed_code_string, codes.Codes):
+        uncompressed_code_string = uncompressed_code_string.to_string()
     uncompressed_code_string = uncompressed_code_string.encode('utf-8')
     if not uncompressed_code_string:
         return ''
@@ -114,28 +141,34 @@ def encode_code_string(uncompressed_code_string):
     return compressed
 
 
-def cut_code_string_length(code_string):
-    """ Remove all codes from a codestring that are > 60 seconds in length.
-    Because we can only match 60 sec, everything else is unnecessary """
-    split = code_string.split()
-    if len(split) < 2:
-        return code_string
+def cut_code_string_length(code, seconds=60):
+    """ Remove all codes from a codestring (or `codes.Codes`) that are > 60 seconds
+    (or the segment length of the index) in length. Because we can only match
+    one segment, everything else is unnecessary. Returns `codes.Codes`. """
+    code = codes.as_codes(code)
+    if not len(code):
+        return code
 
     # If we use the codegen on a file with start/stop times, the first timestamp
-    # is ~= the start time given. There might be a (slightly) earlier timestamp
-    # in another band, but this is good enough
-    first_timestamp = int(split[1])
-    sixty_seconds = int(60.0 * 1000.0 / 23.2 + first_timestamp)
-    parts = []
-    for (code, t) in zip(split[::2], split[1::2]):
-        tstamp = int(t)
-        if tstamp <= sixty_seconds:
-            parts.append(code)
-            parts.append(t)
-    return " ".join(parts)
+    # is ~= the start time given.
+    first_timestamp = int(code.times[0])
+    last_timestamp = int(seconds * 1000.0 / 23.2 + first_timestamp)
+    return code.between(first_timestamp, last_timestamp + 1)
 
 
 def actual_matches(code_string_query, code_string_match, slop=2, elbow=10):
+    """ Scores how well the match aligns with the query: the sum of the two
+        biggest bins of the histogram of time offsets between the matching codes.
+        Both can be code strings or `codes.Codes`, the query may also be
+        a `codes.CompiledQuery` (its slop is used). """
+    query = code_string_query
+    if not isinstance(query, codes.CompiledQuery):
+        query = codes.as_codes(query).compile(slop=slop)
+    return query.score(codes.as_codes(code_string_match), elbow=elbow)
+
+
+def actual_matches_python(code_string_query, code_string_match, slop=2, elbow=10):
+    """ The original pure python `actual_matches`, kept as reference. """
     code_query = code_string_query.split(" ")
     code_match = code_string_match.split(" ")
     if len(code_match) < (elbow * 2):
@@ -193,49 +226,32 @@ def chunker(seq, size):
     return [tuple(seq[pos:pos + size]) for pos in xrange(0, len(seq), size)]
 
 
-def split_codes(fp):
-    """ Split a codestring into a list of codestrings. Each string contains
-        at most 60 seconds of codes, and codes overlap every 30 seconds. Given a
+def segment_range(i, segment_length=60, segment_overlap=30):
+    """ The [start, end) time range of the i-th segment `split_codes` makes. """
+    hop = (segment_length - segment_overlap) * 1000.0 / 23.2
+    return i * hop, i * hop + segment_length * 1000.0 / 23.2
+
+
+def split_codes(fp, segment_length=60, segment_overlap=30):
+    """ Split a fingerprint into fingerprints, yielded one by one. Each contains
+        at most `segment_length` (60) seconds of codes (as a slice of the `codes.Codes`),
+        and consecutive segments overlap by `segment_overlap` (30) seconds. Given a
         track id, return track ids of the form trid-0, trid-1, trid-2, etc. """
+    if not 0 <= segment_overlap < segment_length:
+        raise ValueError("Segment overlap must be at least 0 and less than the segment length")
 
     # Convert seconds into time units
-    segmentlength = 60 * 1000.0 / 23.2
-    halfsegment = segmentlength / 2.0
+    segmentlength = segment_length * 1000.0 / 23.2
+    hop = (segment_length - segment_overlap) * 1000.0 / 23.2
 
     trid = fp["track_id"]
-    codestring = fp["fp"]
-
-    codes = codestring.split()
-    pairs = chunker(codes, 2)
-    pairs = [(int(x[1]), " ".join(x)) for x in pairs]
-
-    pairs.sort()
-    size = len(pairs)
-
-    if len(pairs):
-        lasttime = pairs[-1][0]
-        numsegs = int(lasttime / halfsegment) + 1
-    else:
-        numsegs = 0
-
-    ret = []
-    sindex = 0
-    for i in range(numsegs):
-        s = i * halfsegment
-        e = i * halfsegment + segmentlength
-        # print i, s, e
-
-        while sindex < size and pairs[sindex][0] < s:
-            # print "s", sindex, l[sindex]
-            sindex += 1
-        eindex = sindex
-        while eindex < size and pairs[eindex][0] < e:
-            # print "e",eindex,l[eindex]
-            eindex += 1
+    code = codes.as_codes(fp["fp"])
+
+    for i, segment_code in enumerate(code.windows(segmentlength, hop)):
         key = "%s-%d" % (trid, i)
 
         segment = {"track_id": key,
-                   "fp": " ".join((p[1]) for p in pairs[sindex:eindex]),
+                   "fp": segment_code,
                    "length": fp["length"],
                    "codever": fp["codever"]}
         if "artist" in fp:
@@ -248,57 +264,247 @@ def split_codes(fp):
             segment["source"] = fp["source"]
         if "import_date" in fp:
             segment["import_date"] = fp["import_date"]
-        ret.append(segment)
-    return ret
+        yield segment
+
+
+class BaseFingerPrinter(object):
+    """ The matching logic of the echoprint server, independent of where
+        the fingerprints are stored. Subclasses provide the candidate lookup
+        (`query_fp`), the histogram rescoring of those candidates
+        (`actual_scores`) and `metadata_for_track_id`.
+
+        Candidates are rescored in steps of `depths` (see `_adaptive_actual_scores`),
+        the default rescores all 30 at once, `ADAPTIVE_DEPTHS` starts with 5.
+
+        Tracks are stored in segments of `segment_length` seconds overlapping by
+        `segment_overlap` seconds (see `split_codes`), queries are cut to one segment. """
+    slop = 2
+    depths = (30,)
+    ADAPTIVE_DEPTHS = (5, 15, 30)
+    segment_length = 60
+    segment_overlap = 30
+
+    def __init__(self, metadata_cache_size=10000, depths=None, segment_length=None, segment_overlap=None):
+        if depths is not None:
+            if not depths or list(depths) != sorted(depths):
+                raise ValueError("depths must be a non-empty ascending sequence")
+            self.depths = tuple(depths)
+        if segment_length is not None:
+            self.segment_length = segment_length
+        if segment_overlap is not None:
+            self.segment_overlap = segment_overlap
+        if not 0 <= self.segment_overlap < self.segment_length:
+            raise ValueError("Segment overlap must be at least 0 and less than the segment length")
+        self.latency = stats.LatencyStats()
+        # base track id -> metadata, for winners without metadata in their candidate row
+        self.metadata_cache = cache.LRUCache(metadata_cache_size)
+
+    def segmentation(self):
+        """ The (segment length, segment overlap) in seconds the index uses. """
+        return self.segment_length, self.segment_overlap
+
+    def stats(self):
+        """ Latency percentiles of the recent queries for every
+            stage (decode, solr, tyrant, rescore, metadata and total)
+            and of the batches of `best_match_for_queries`. """
+        return self.latency.stats()
+
+    def cache_stats(self):
+        """ Size and hit rate of the caches, see `cache.LRUCache.stats`. """
+        return {"metadata": self.metadata_cache.stats()}
 
+    def metadata_for_track_id(self, track_id, append_end=True):
+        raise NotImplementedError
 
-class FingerPrinter(object):
-    def __init__(self, solr_url="http://localhost:8502/solr/fp", tyrant_address=("localhost", 1978)):
-        self._fp_solr = solr.SolrConnectionPool(solr_url)
-        self._tyrant_address = tyrant_address
-        self._tyrant = None
+    def query_fp(self, code_string, rows=15, get_data=False):
+        """ The candidates (a `solr.Response`) for a code string or `codes.Codes`. """
+        raise NotImplementedError
+
+    def actual_scores(self, query, track_ids, elbow=10, timings=None, prefetched=None):
+        """ Returns a dict of track_id -> actual score (see `actual_matches`)
+            against the `codes.CompiledQuery`, track ids which are not in
+            the store are left out.
+            The time spent is added to `timings` (a `stats.Timings`),
+            `prefetched` is what `prefetch_codes` returned. """
+        raise NotImplementedError
+
+    def _metadata_for_match(self, trackid, results):
+        """ Metadata of the (base) track id `trackid`, taken from its candidate
+            row in `results` if it has the fields, else from the metadata cache
+            or `metadata_for_track_id`. """
+        for row in results:
+            if row["track_id"].split("-")[0] == trackid and "length" in row:
+                meta = dict((k, row[k]) for k in METADATA_FIELDS if k in row)
+                meta["track_id"] = trackid
+                return meta
+
+        meta = self.metadata_cache.get(trackid)
+        if meta is None:
+            meta = self.metadata_for_track_id(trackid)
+            if meta:
+                self.metadata_cache.set(trackid, meta)
+        return meta
+
+    def _adaptive_actual_scores(self, query, results, elbow, timings, prefetched=None):
+        """ Rescores the candidates (sorted by Solr score) in steps of `depths`. Stops
+            early once the candidates left can't change the decision: their Solr score,
+            roughly an upper bound of the actual score, neither beats the top actual
+            score nor comes within a third of it. Returns (scores, depth). """
+        track_ids = [r["track_id"] for r in results]
+        scores = {}
+        depth = 0
+        for step in self.depths:
+            step = min(step, len(track_ids))
+            if step <= depth:
+                continue
 
-    @property
-    def tyrant(self):
-        if self._tyrant is None:
-            self._tyrant = pytyrant.PyTyrant.open(*self._tyrant_address)
-        return self._tyrant
+            scores.update(self.actual_scores(query, track_ids[depth:step], elbow=elbow,
+                                             timings=timings, prefetched=prefetched))
+            depth = step
+            if depth == len(track_ids):
+                break
 
-    def metadata_for_track_id(self, track_id, append_end=True):
-        if not track_id or not len(track_id):
-            return {}
-        # Assume track_ids have 1 - and it's at the end of the id.
-        if append_end:
-            track_id = "%s-0" % track_id
-
-        with solr.pooled_connection(self._fp_solr) as host:
-            response = host.query("track_id:%s" % track_id)
+            top_score = max(scores.itervalues()) if scores else 0
+            if int(results[depth]["score"]) <= top_score - top_score / 3:
+                break
+        return scores, depth
 
-        if len(response.results):
-            return response.results[0]
+    def best_match_for_query(self, code_string, elbow=10):
+        """ Finds the track matching the query, a compressed or decoded
+            code string or `codes.Codes`. Returns a `Response`. """
+        timings = stats.Timings()
+        response = self._best_match_for_query(code_string, elbow, timings)
+        return self._record(response, timings)
+
+    def best_match_for_queries(self, code_strings, elbow=10, concurrency=8):
+        """ `best_match_for_query` for many queries. Up to `concurrency` Solr
+            queries run at once (in threads, cooperative under gevent), the
+            first candidates of all queries are fetched from the keystore
+            together. Returns the `Response`s in the order of the queries.
+            The total time of a query is the time spent on it (its stages),
+            the time of the whole batch is recorded as "batch". """
+        tic = int(time.time() * 1000)
+        timings = [stats.Timings() for _ in code_strings]
+        responses = []
+        for code_string, t in zip(code_strings, timings):
+            with t.stage("decode"):
+                responses.append(self._prepare_query(code_string, elbow, tic))
+
+        pending = [i for i, r in enumerate(responses) if not isinstance(r, Response)]
+        candidates = self._query_fp_many([responses[i][0] for i in pending],
+                                         [timings[i] for i in pending], concurrency)
+
+        track_ids = set()
+        for response in candidates:
+            # None if Solr failed, _match_candidates answers NO_RESULTS
+            if response is not None and len(response.results) > 1:
+                track_ids.update(r["track_id"] for r in response.results[:self.depths[0]])
+        prefetch_tic = time.time()
+        prefetched = self.prefetch_codes(sorted(track_ids))
+        # the fetch is shared, every query gets its part of it
+        prefetch_ms = (time.time() - prefetch_tic) * 1000 / max(len(pending), 1)
+
+        for i, response in zip(pending, candidates):
+            code, query = responses[i]
+            timings[i].add("tyrant", prefetch_ms)
+            responses[i] = self._match_candidates(response, query, len(code), elbow, timings[i], tic, prefetched)
+
+        # the queries overlap, the time since tic is the batch's
+        for response, t in zip(responses, timings):
+            response.total_time = int(sum(t.stages.itervalues()))
+        self.latency.record({"batch": int(time.time() * 1000) - tic})
+        return [self._record(r, t) for r, t in zip(responses, timings)]
+
+    def _query_fp_many(self, code_list, timings, concurrency):
+        results = [None] * len(code_list)
+        jobs = Queue.Queue()
+        for i in xrange(len(code_list)):
+            jobs.put(i)
+
+        errors = []
+
+        def worker():
+            while True:
+                try:
+                    i = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    with timings[i].stage("solr"):
+                        results[i] = self.query_fp(code_list[i], rows=self.depths[-1], get_data=True)
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        threads = [threading.Thread(target=worker) for _ in xrange(min(concurrency, len(code_list)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def _record(self, response, timings):
+        response.timings = dict(timings.stages)
+        timings.add("total", response.total_time)
+        self.latency.record(timings.stages)
+        return response
+
+    def prefetch_codes(self, track_ids):
+        """ Codes of the candidates of many queries fetched at once, passed on
+            to `actual_scores` as `prefetched`. """
         return {}
 
-    def best_match_for_query(self, code_string, elbow=10):
-        # DEC strings come in as unicode so we have to force them to ASCII
-        code_string = code_string.encode("utf8")
+    def _best_match_for_query(self, code_string, elbow, timings):
         tic = int(time.time() * 1000)
 
-        # First see if this is a compressed code
-        if re.match('[A-Za-z/\+_\-]', code_string) is not None:
-            code_string = decode_code_string(code_string)
-            if code_string is None:
-                return Response(Response.CANNOT_DECODE, tic=tic)
+        with timings.stage("decode"):
+            prepared = self._prepare_query(code_string, elbow, tic)
+        if isinstance(prepared, Response):
+            return prepared
+        code, query = prepared
+
+        # Query the FP flat directly.
+        with timings.stage("solr"):
+            response = self.query_fp(code, rows=self.depths[-1], get_data=True)
+        return self._match_candidates(response, query, len(code), elbow, timings, tic)
+
+    def _prepare_query(self, code_string, elbow, tic):
+        """ Decodes and cuts the query, returns (codes.Codes, codes.CompiledQuery)
+            or a `Response` if it can't be used. """
+        if isinstance(code_string, codes.Codes):
+            code = code_string
+        else:
+            # DEC strings come in as unicode so we have to force them to ASCII
+            code_string = code_string.encode("utf8")
+            # First see if this is a compressed code
+            if re.match('[A-Za-z/\+_\-]', code_string) is not None:
+                code = decode_code_string(code_string)
+                if code is None:
+                    return Response(Response.CANNOT_DECODE, tic=tic)
+            else:
+                try:
+                    code = codes.Codes.from_string(code_string)
+                except ValueError as e:
+                    logger.warn("Could not parse query code string: %s" % e)
+                    return Response(Response.CANNOT_DECODE, tic=tic)
 
-        code_len = len(code_string.split(" ")) / 2
+        code_len = len(code)
         if code_len < elbow:
             logger.warn("Query code length (%d) is less than elbow (%d)" % (code_len, elbow))
             return Response(Response.NOT_ENOUGH_CODE, tic=tic)
 
-        code_string = cut_code_string_length(code_string)
-        code_len = len(code_string.split(" ")) / 2
+        code = cut_code_string_length(code, self.segmentation()[0])
+        # inverted once, then scored against every candidate
+        return code, code.compile(slop=self.slop)
 
-        # Query the FP flat directly.
-        response = self.query_fp(code_string, rows=30, get_data=True)
+    def _match_candidates(self, response, query, code_len, elbow, timings, tic, prefetched=None):
+        """ Picks the match from the Solr candidates. """
+        if response is None:
+            # Solr failed or all connections are busy, answer without a match
+            logger.warn("No candidates from solr")
+            return Response(Response.NO_RESULTS, tic=tic)
         logger.debug("solr qtime is %d" % (response.header["QTime"]))
 
         if len(response.results) == 0:
@@ -310,8 +516,9 @@ class FingerPrinter(object):
         if len(response.results) == 1:
             trackid = response.results[0]["track_id"]
             trackid = trackid.split("-")[0]  # will work even if no `-` in trid
-            meta = self.metadata_for_track_id(trackid)
             if code_len - top_match_score < elbow:
+                with timings.stage("metadata"):
+                    meta = self._metadata_for_match(trackid, response.results)
                 return Response(Response.SINGLE_GOOD_MATCH, TRID=trackid, score=top_match_score,
                                 qtime=response.header["QTime"], tic=tic, metadata=meta)
             else:
@@ -324,22 +531,9 @@ class FingerPrinter(object):
         # Not a strong match, so we look up the codes in the keystore and compute actual matches...
 
         # Get the actual score for all responses
-        original_scores = {}
-        actual_scores = {}
-
-        trackids = [r["track_id"].encode("utf8") for r in response.results]
-        tcodes = self.tyrant.multi_get(trackids)
-
-        # For each result compute the "actual score" (based on the histogram matching)
-        for (i, r) in enumerate(response.results):
-            track_id = r["track_id"]
-            original_scores[track_id] = int(r["score"])
-            track_code = tcodes[i]
-            if track_code is None:
-                # Solr gave us back a track id but that track
-                # is not in our keystore
-                continue
-            actual_scores[track_id] = actual_matches(code_string, track_code, elbow=elbow)
+        original_scores = dict((r["track_id"], int(r["score"])) for r in response.results)
+        actual_scores, depth = self._adaptive_actual_scores(query, response.results, elbow, timings, prefetched)
+        logger.debug("rescored %d of %d candidates" % (depth, len(response.results)))
 
         # logger.debug("Actual score for %s is %d (code_len %d),
         # original was %d" % (r["track_id"], actual_scores[r["track_id"]], code_len, top_match_score))
@@ -357,26 +551,29 @@ class FingerPrinter(object):
                 existing_trids.append(trid_split)
         sorted_actual_scores = new_sorted_actual_scores
 
-        # We might have reduced the length of the list to 1
+        # We might have reduced the length of the list to 1, also after an early
+        # exit, which then has to decide like rescoring all candidates
         if len(sorted_actual_scores) == 1:
             logger.info("only have 1 score result...")
             (top_track_id, top_score) = sorted_actual_scores[0]
             if top_score < code_len * 0.1:
                 logger.info("only result less than 10%% of the query string (%d < %d *0.1 (%d)) SINGLE_BAD_MATCH",
                             top_score, code_len, code_len * 0.1)
-                return Response(Response.SINGLE_BAD_MATCH, qtime=response.header["QTime"], tic=tic)
+                return Response(Response.SINGLE_BAD_MATCH, qtime=response.header["QTime"], tic=tic, depth=depth)
             else:
                 if top_score > (original_scores[top_track_id] / 2):
                     logger.info("top_score > original_scores[%s]/2 (%d > %d) GOOD_MATCH_DECREASED",
                                 top_track_id, top_score, original_scores[top_track_id] / 2)
                     trid = top_track_id.split("-")[0]
-                    meta = self.metadata_for_track_id(trid)
+                    with timings.stage("metadata"):
+                        meta = self._metadata_for_match(trid, response.results)
                     return Response(Response.MULTIPLE_GOOD_MATCH_HISTOGRAM_DECREASED, TRID=trid, score=top_score,
-                                    qtime=response.header["QTime"], tic=tic, metadata=meta)
+                                    qtime=response.header["QTime"], tic=tic, metadata=meta, depth=depth)
                 else:
                     logger.info("top_score NOT > original_scores[%s]/2 (%d <= %d) BAD_HISTOGRAM_MATCH",
                                 top_track_id, top_score, original_scores[top_track_id] / 2)
-                    return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic)
+                    return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic,
+                                    depth=depth)
 
         # Get the top one
         (actual_score_top_track_id, actual_score_top_score) = sorted_actual_scores[0]
@@ -384,32 +581,210 @@ class FingerPrinter(object):
         (actual_score_2nd_track_id, actual_score_2nd_score) = sorted_actual_scores[1]
 
         trackid = actual_score_top_track_id.split("-")[0]
-        meta = self.metadata_for_track_id(trackid)
 
         if actual_score_top_score < code_len * 0.05:
-            return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic)
+            return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic,
+                            depth=depth)
         else:
             # If the actual score went down it still could be close enough, so check for that
             if actual_score_top_score > (original_scores[actual_score_top_track_id] / 4):
                 # for examples [10,4], 10-4 = 6, which >= 5, so OK
                 if (actual_score_top_score - actual_score_2nd_score) >= (actual_score_top_score / 3):
+                    with timings.stage("metadata"):
+                        meta = self._metadata_for_match(trackid, response.results)
                     return Response(Response.MULTIPLE_GOOD_MATCH_HISTOGRAM_DECREASED, TRID=trackid,
                                     score=actual_score_top_score, qtime=response.header["QTime"], tic=tic,
-                                    metadata=meta)
+                                    metadata=meta, depth=depth)
                 else:
-                    return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic)
+                    return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic,
+                                    depth=depth)
             else:
                 # If the actual score was not close enough, then no match.
-                return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic)
+                return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic,
+                                depth=depth)
+
+
+class FingerPrinter(BaseFingerPrinter):
+    """ Fingerprints are indexed in Solr and their codes are kept in Tokyo Tyrant
+        for rescoring, either per segment (`SEGMENTS`, what the echoprint server
+        does) or, with `TRACKS` storage, once per track as `codes.Codes.to_bytes`
+        blob, the segments are sliced out of it.
+        `solr_options` are passed to the `solr.SolrConnection`s, e.g.
+        {"json_updates": True} to stream ingests as JSON in requests of
+        at most `solr.JSON_BATCH_SIZE` documents.
+        `solr_url` can be a list of replicas, queries are balanced across all
+        of them by a `solr.SolrReplicaPool`, updates go to the first one.
+        Queries use their own connections, all attempts of a query take at
+        most `query_deadline` seconds (unless `solr_options` has a
+        "retry_policy"), updates and commits aren't bounded. """
+    SEGMENTS, TRACKS = "segments", "tracks"
+
+    # keystore keys of the settings the index was built with
+    SEGMENTATION_KEY = "__segmentation__"
+    STORAGE_KEY = "__storage__"
+    # how the echoprint server builds an index, assumed for an
+    # index which holds documents but has no settings recorded
+    LEGACY_SETTINGS = {SEGMENTATION_KEY: [60, 30], STORAGE_KEY: SEGMENTS}
+
+    def __init__(self, solr_url="http://localhost:8502/solr/fp", tyrant_address=("localhost", 1978),
+                 metadata_cache_size=10000, depths=None, codes_cache_bytes=64 * 1024 * 1024,
+                 segment_length=None, segment_overlap=None, storage=None, solr_options=None,
+                 query_deadline=15):
+        BaseFingerPrinter.__init__(self, metadata_cache_size, depths, segment_length, segment_overlap)
+        if storage not in (None, self.SEGMENTS, self.TRACKS):
+            raise ValueError("Unknown storage %r" % storage)
+        # only checked against the index if given explicitly
+        self._configured = {self.SEGMENTATION_KEY: None, self.STORAGE_KEY: storage}
+        if segment_length is not None or segment_overlap is not None:
+            self._configured[self.SEGMENTATION_KEY] = [self.segment_length, self.segment_overlap]
+        # key -> (value, recorded in the keystore)
+        self._settings = {}
+        solr_options = solr_options or {}
+        query_options = dict(solr_options)
+        query_options.setdefault("retry_policy", solr.RetryPolicy(deadline=query_deadline))
+        if isinstance(solr_url, (list, tuple)):
+            self._fp_solr = solr.SolrReplicaPool(solr_url, **query_options)
+            self._fp_solr_update = solr.SolrConnectionPool(solr_url[0], **solr_options)
+        else:
+            self._fp_solr = solr.SolrConnectionPool(solr_url, **query_options)
+            self._fp_solr_update = solr.SolrConnectionPool(solr_url, **solr_options)
+        self._tyrant_address = tyrant_address
+        self._tyrant = None
+        # track id -> parsed codes.Codes of the keystore, 0 disables the cache
+        self.codes_cache = cache.LRUCache(None, codes_cache_bytes, lambda c: c.nbytes)
+
+    @property
+    def tyrant(self):
+        if self._tyrant is None:
+            self._tyrant = pytyrant.PyTyrant.open(*self._tyrant_address)
+        return self._tyrant
+
+    def _index_setting(self, key, default):
+        """ The setting recorded in the index under `key`, the configured one
+            (or `default`) if nothing was ingested yet. An index with documents
+            but without the setting is recorded with its `LEGACY_SETTINGS`.
+            Raises ValueError if it differs from the configured one. """
+        if key not in self._settings:
+            configured = self._configured[key]
+            recorded = self.tyrant.get(key)
+            if recorded is None and len(self.tyrant):
+                recorded = json.dumps(self.LEGACY_SETTINGS[key])
+                self.tyrant[key] = recorded
+            if recorded is None:
+                self._settings[key] = (configured if configured is not None else default, False)
+            else:
+                recorded = json.loads(recorded)
+                if configured is not None and configured != recorded:
+                    raise ValueError("Index is built with %s %r, not %r" % (key.strip("_"), recorded, configured))
+                self._settings[key] = (recorded, True)
+        return self._settings[key][0]
+
+    def _record_index_setting(self, key):
+        value, recorded = self._settings[key]
+        if not recorded:
+            self.tyrant[key] = json.dumps(value)
+            self._settings[key] = (value, True)
+
+    def segmentation(self):
+        """ The (segment length, segment overlap) recorded in the index. """
+        return tuple(self._index_setting(self.SEGMENTATION_KEY, list(BaseFingerPrinter.segmentation(self))))
+
+    def storage(self):
+        """ How the index keeps the codes, `SEGMENTS` or `TRACKS`. """
+        return self._index_setting(self.STORAGE_KEY, self.SEGMENTS)
+
+    def metadata_for_track_id(self, track_id, append_end=True):
+        if not track_id or not len(track_id):
+            return {}
+        # Assume track_ids have 1 - and it's at the end of the id.
+        if append_end:
+            track_id = "%s-0" % track_id
+
+        with solr.pooled_connection(self._fp_solr) as host:
+            response = host.query("track_id:%s" % track_id, use_json_parser=True)
+
+        if len(response.results):
+            return response.results[0]
+        return {}
+
+    def actual_scores(self, query, track_ids, elbow=10, timings=None, prefetched=None):
+        if timings is None:
+            timings = stats.Timings()
+
+        tcodes = dict(prefetched or {})
+        with timings.stage("tyrant"):
+            missing = [t for t in track_ids if t not in tcodes]
+            tcodes.update(zip(missing, self.codes_for_track_ids(missing)))
+
+        # For each result compute the "actual score" (based on the histogram matching)
+        scores = {}
+        with timings.stage("rescore"):
+            for track_id in track_ids:
+                track_code = tcodes[track_id]
+                if track_code is None:
+                    # Solr gave us back a track id but that track
+                    # is not in our keystore
+                    continue
+                scores[track_id] = actual_matches(query, track_code, elbow=elbow)
+        return scores
+
+    def codes_for_track_ids(self, track_ids):
+        """ The `codes.Codes` of the tracks (segments) from the codes cache,
+            the misses are fetched from the keystore in one go. None for
+            tracks which aren't stored. """
+        if self.storage() == self.TRACKS:
+            return self._segments_for_track_ids(track_ids)
+        return self._codes_for_keys([t.encode("utf8") for t in track_ids], codes.Codes.from_string)
+
+    def _codes_for_keys(self, keys, parse):
+        result = [self.codes_cache.get(key) for key in keys]
+
+        misses = [i for i, code in enumerate(result) if code is None]
+        if misses:
+            for i, code in zip(misses, self.tyrant.multi_get([keys[i] for i in misses])):
+                if code is not None:
+                    result[i] = parse(code)
+                    self.codes_cache.set(keys[i], result[i])
+        return result
+
+    def _segments_for_track_ids(self, track_ids):
+        """ Slices the segments out of the per track blobs. """
+        segment_length, segment_overlap = self.segmentation()
+        keys = list(set(t.split("-")[0].encode("utf8") for t in track_ids))
+        tracks = dict(zip(keys, self._codes_for_keys(keys, codes.Codes.from_bytes)))
+
+        result = []
+        for track_id in track_ids:
+            trid, _, segment = track_id.partition("-")
+            code = tracks[trid.encode("utf8")]
+            if code is not None and segment:
+                code = code.between(*segment_range(int(segment), segment_length, segment_overlap))
+            result.append(code)
+        return result
+
+    def prefetch_codes(self, track_ids):
+        return dict(zip(track_ids, self.codes_for_track_ids(track_ids)))
+
+    def cache_stats(self):
+        result = BaseFingerPrinter.cache_stats(self)
+        result["codes"] = self.codes_cache.stats()
+        return result
+
+    def pool_stats(self):
+        """ Connections of the Solr pools, see `solr.ConnectionPool.stats`. """
+        return {"solr": self._fp_solr.stats(), "solr_update": self._fp_solr_update.stats()}
 
     def delete(self, track_ids, do_commit=True):
         # delete one or more track_ids from the fp flat.
         if not isinstance(track_ids, list):
             track_ids = [track_ids]
 
-        with solr.pooled_connection(self._fp_solr) as host:
+        with solr.pooled_connection(self._fp_solr_update) as host:
             for t in track_ids:
                 host.delete_query("track_id:%s*" % t)
+                self.metadata_cache.pop(t.split("-")[0])
+                prefix = t.encode("utf8")
+                self.codes_cache.pop_where(lambda key: key.startswith(prefix))
 
         try:
             self.tyrant.multi_del(track_ids)
@@ -426,9 +801,12 @@ class FingerPrinter(object):
         if not really_delete:
             raise Exception("Won't delete unless you pass in really_delete=True")
 
-        with solr.pooled_connection(self._fp_solr) as host:
+        with solr.pooled_connection(self._fp_solr_update) as host:
             host.delete_query("*:*")
             host.commit()
+        self.metadata_cache.clear()
+        self.codes_cache.clear()
+        self._settings = {}
 
         self.tyrant.multi_del(self.tyrant.keys())
 
@@ -436,7 +814,7 @@ class FingerPrinter(object):
         """ Ingest some fingerprints into the fingerprint database.
             The fingerprints should be of the form
               {"track_id": id,
-              "fp": fp string,
+              "fp": fp string or codes.Codes,
               "artist": artist,
               "release": release,
               "track": track,
@@ -455,9 +833,13 @@ class FingerPrinter(object):
         if not isinstance(fingerprint_list, list):
             fingerprint_list = [fingerprint_list]
 
-        docs = []
-        codes = []
+        segments = fingerprint_list
+        storage = self.storage()
+        if storage == self.TRACKS and not split:
+            raise ValueError("Storing whole tracks requires split=True")
+
         if split:
+            segmentation = self.segmentation()
             for fprint in fingerprint_list:
                 if not ("track_id" in fprint and "fp" in fprint and "length" in fprint and "codever" in fprint):
                     raise ValueError("Missing required fingerprint parameters (track_id, fp, length, codever")
@@ -465,40 +847,74 @@ class FingerPrinter(object):
                     fprint["import_date"] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
                 if "source" not in fprint:
                     fprint["source"] = "local"
-                split_prints = split_codes(fprint)
-                docs.extend(split_prints)
-                codes.extend(((c["track_id"].encode("utf-8"), c["fp"].encode("utf-8")) for c in split_prints))
-        else:
-            docs.extend(fingerprint_list)
-            codes.extend(((c["track_id"].encode("utf-8"), c["fp"].encode("utf-8")) for c in fingerprint_list))
-
-        with solr.pooled_connection(self._fp_solr) as host:
-            host.add_many(docs)
-
-        self.tyrant.multi_set(codes)
+            # first split ingest, record how the index is built
+            self._record_index_setting(self.SEGMENTATION_KEY)
+            self._record_index_setting(self.STORAGE_KEY)
+            # parsed once, for the segments and the track blobs
+            fingerprint_list = [dict(fprint, fp=codes.as_codes(fprint["fp"])) for fprint in fingerprint_list]
+            segments = itertools.chain.from_iterable(split_codes(fprint, *segmentation)
+                                                     for fprint in fingerprint_list)
+
+        track_ids = set()
+        values = []
+        if storage == self.TRACKS:
+            values = [(fprint["track_id"].encode("utf-8"), fprint["fp"].to_bytes())
+                      for fprint in fingerprint_list]
+
+        def docs():
+            for doc in segments:
+                # Solr (and the keystore for segment storage) store the decoded
+                # code string, it's built once per segment right before it goes out
+                if isinstance(doc["fp"], codes.Codes):
+                    doc = dict(doc, fp=doc["fp"].to_string())
+                track_ids.add(doc["track_id"].split("-")[0])
+                if storage == self.SEGMENTS:
+                    values.append((doc["track_id"].encode("utf-8"), doc["fp"].encode("utf-8")))
+                yield doc
+
+        with solr.pooled_connection(self._fp_solr_update) as host:
+            host.add_many(docs())
+
+        self.tyrant.multi_set(values)
+        for trid in track_ids:
+            self.metadata_cache.pop(trid)
+        for key, _ in values:
+            self.codes_cache.pop(key)
 
         if do_commit:
             self.commit()
 
     def commit(self):
-        with solr.pooled_connection(self._fp_solr) as host:
+        with solr.pooled_connection(self._fp_solr_update) as host:
             host.commit()
 
     def query_fp(self, code_string, rows=15, get_data=False):
+        if isinstance(code_string, codes.Codes):
+            code_string = code_string.to_string()
         try:
             # query the fp flat
             if get_data:
-                fields = "track_id,artist,release,track,length"
+                fields = ",".join(METADATA_FIELDS)
             else:
                 fields = "track_id"
             with solr.pooled_connection(self._fp_solr) as host:
-                resp = host.query(code_string, qt="/hashq", rows=rows, fields=fields)
+                resp = host.query(code_string, qt="/hashq", rows=rows, fields=fields, use_json_parser=True)
             return resp
         except solr.SolrException:
             return None
 
+    def export(self, fields=METADATA_FIELDS, block_size=1000):
+        """ Yields the documents (one per segment) of the whole Solr index
+            with the `fields`, see `solr.SolrConnection.stream_query`. The
+            connection is held until the generator is exhausted or closed, it's
+            taken from the (first) replica updates go to. """
+        with solr.pooled_connection(self._fp_solr_update) as host:
+            for doc in host.stream_query("*:*", fields=fields, unique_key="track_id", block_size=block_size):
+                yield doc
+
     def fp_code_for_track_id(self, track_id):
-        return self.tyrant.get(track_id.encode("utf-8"))
+        """ The `codes.Codes` of a track (segment), None if it isn't stored. """
+        return self.codes_for_track_ids([track_id])[0]
 
 
 def new_track_id():
@@ -0,0 +1,404 @@
+"""
+A stand-in for the echoprint Solr core: an in-memory index behind a
+small HTTP server with the handlers emfas uses, /select (including the
+/hashq query type), /update (XML and JSON) and commit, answering in the
+same formats. Meant for tests and benchmarks on one machine.
+
+    server = LocalSolrServer(('127.0.0.1', 0))
+    url = server.start()
+    fp = FingerPrinter(url)
+    ...
+    server.stop()
+
+Queries support `*:*`, `field:value` and `field:prefix*` (also as fq),
+fl, rows, start, sort and cursorMark. Like Solr, updates are only
+visible after a commit.
+"""
+import BaseHTTPServer
+import SocketServer
+import base64
+import collections
+import functools
+import json
+import threading
+import time
+import urlparse
+import zlib
+from xml.etree import cElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+import embedded
+
+
+class LocalSolrException(Exception):
+    """ A bad request, answered with HTTP 400. """
+    pass
+
+
+def _compare(specs, a, b):
+    for i, (_, descending) in enumerate(specs):
+        c = cmp(a[i], b[i])
+        if c:
+            return -c if descending else c
+    return 0
+
+
+class LocalIndex(object):
+    """ The documents by `unique_key` and the hash codes of their
+        `fp_field` in an `embedded.EmbeddedFingerPrinter`, which does
+        the /hashq scoring. Field values added as XML are strings,
+        `types` converts them, e.g. {'length': int}. """
+    def __init__(self, unique_key='track_id', fp_field='fp', types=None):
+        self.unique_key = unique_key
+        self.fp_field = fp_field
+        self.types = {'length': int} if types is None else types
+        self._docs = collections.OrderedDict()
+        self._codes = embedded.EmbeddedFingerPrinter()
+        # ('add', doc), ('delete_id', id) or ('delete_query', predicate) until the next commit
+        self._pending = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, doc):
+        if self.unique_key not in doc:
+            raise LocalSolrException('Document is missing the unique key %s' % self.unique_key)
+        doc = dict(doc)
+        for field, convert in self.types.iteritems():
+            if isinstance(doc.get(field), basestring):
+                doc[field] = convert(doc[field])
+        with self._lock:
+            self._pending.append(('add', doc))
+
+    def delete_id(self, doc_id):
+        with self._lock:
+            self._pending.append(('delete_id', doc_id))
+
+    def delete_query(self, q):
+        matches = self._matcher(q)
+        with self._lock:
+            self._pending.append(('delete_query', matches))
+
+    def commit(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            for op, arg in pending:
+                if op == 'add':
+                    doc_id = arg[self.unique_key]
+                    # replaced documents move to the end, like in a Lucene index
+                    self._docs.pop(doc_id, None)
+                    self._docs[doc_id] = arg
+                    self._codes._add(doc_id, arg.get(self.fp_field) or '')
+                elif op == 'delete_id':
+                    self._delete([arg])
+                else:
+                    self._delete([d for d, doc in self._docs.iteritems() if arg(doc)])
+            self._codes.commit()
+
+    def _delete(self, doc_ids):
+        doc_ids = [d for d in doc_ids if d in self._docs]
+        for doc_id in doc_ids:
+            del self._docs[doc_id]
+        if doc_ids:
+            self._codes.delete(doc_ids, do_commit=False)
+
+    def _matcher(self, q):
+        """ A predicate for the documents matching the query `q`. """
+        q = q.strip()
+        if q in ('*:*', '*'):
+            return lambda doc: True
+        field, sep, value = q.partition(':')
+        if not sep or not field or not value or ' ' in q:
+            raise LocalSolrException('Unsupported query %r' % q)
+        value = value.strip('"')
+
+        def values(doc):
+            v = doc.get(field)
+            if isinstance(v, (list, tuple)):
+                return [unicode(x) for x in v]
+            return [] if v is None else [unicode(v)]
+
+        if value.endswith('*'):
+            prefix = value[:-1]
+            return lambda doc: any(v.startswith(prefix) for v in values(doc))
+        return lambda doc: value in values(doc)
+
+    def select(self, q, fq=(), fl='*', rows=10, start=0, sort=None, cursor=None):
+        """ Returns (documents, number found, next cursor mark or None). """
+        fields, _ = self._fields(fl)
+        with self._lock:
+            match = self._matcher(q)
+            filters = [self._matcher(f) for f in fq]
+            docs = [doc for doc in self._docs.itervalues()
+                    if match(doc) and all(f(doc) for f in filters)]
+
+        specs = []
+        for spec in (sort or '').split(','):
+            spec = spec.split()
+            if spec:
+                specs.append((spec[0], len(spec) > 1 and spec[1].lower() == 'desc'))
+        if cursor is not None and self.unique_key not in [f for f, _ in specs]:
+            raise LocalSolrException('Cursors require a sort on the unique key %s' % self.unique_key)
+
+        def sort_values(doc):
+            return [doc.get(f) for f, _ in specs]
+
+        compare = functools.partial(_compare, specs)
+        docs.sort(cmp=compare, key=sort_values)
+        found = len(docs)
+
+        next_cursor = None
+        if cursor is not None:
+            if cursor != '*':
+                after = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+                docs = [doc for doc in docs if compare(sort_values(doc), after) > 0]
+            docs = docs[:rows]
+            next_cursor = cursor
+            if docs:
+                next_cursor = base64.urlsafe_b64encode(json.dumps(sort_values(docs[-1])))
+        else:
+            docs = docs[start:start + rows]
+
+        return [self._project(doc, fields) for doc in docs], found, next_cursor
+
+    def hashq(self, code_string, fl='*', rows=10):
+        """ The documents sharing the most distinct hash codes with
+            `code_string`, the number of codes is their score. """
+        fields, score = self._fields(fl)
+        with self._lock:
+            results = self._codes.query_fp(code_string, rows=rows).results
+            docs = []
+            for result in results:
+                doc = self._project(self._docs[result['track_id']], fields)
+                if score:
+                    doc['score'] = float(result['score'])
+                docs.append(doc)
+        return docs, len(docs)
+
+    def _fields(self, fl):
+        """ (the stored fields `fl` lists, None for all of them, whether it lists score) """
+        fields = set(f for f in fl.replace(' ', ',').split(',') if f)
+        score = 'score' in fields
+        fields.discard('score')
+        if not fields or '*' in fields:
+            return None, score
+        return fields, score
+
+    def _project(self, doc, fields):
+        if fields is None:
+            return dict(doc)
+        return dict((k, v) for k, v in doc.iteritems() if k in fields)
+
+
+def _xml_value(value, name=None):
+    attr = '' if name is None else ' name=%s' % quoteattr(name)
+    if isinstance(value, bool):
+        return '<bool%s>%s</bool>' % (attr, 'true' if value else 'false')
+    if isinstance(value, (int, long)):
+        tag = 'int' if -2 ** 31 <= value < 2 ** 31 else 'long'
+        return '<%s%s>%d</%s>' % (tag, attr, value, tag)
+    if isinstance(value, float):
+        return '<float%s>%r</float>' % (attr, value)
+    if isinstance(value, (list, tuple)):
+        return '<arr%s>%s</arr>' % (attr, ''.join(_xml_value(v) for v in value))
+    if isinstance(value, dict):
+        return '<lst%s>%s</lst>' % (attr, ''.join(_xml_value(v, k) for k, v in value.iteritems()))
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return '<str%s>%s</str>' % (attr, escape(value))
+
+
+def to_xml(body):
+    """ The wt=standard (version 2.2) representation of a response. """
+    xml = [u'<?xml version="1.0" encoding="UTF-8"?>\n<response>',
+           _xml_value(body['responseHeader'], 'responseHeader')]
+    if 'response' in body:
+        result = body['response']
+        xml.append(u'<result name="response" numFound="%d" start="%d">' % (result['numFound'], result['start']))
+        for doc in result['docs']:
+            xml.append(u'<doc>%s</doc>' % ''.join(_xml_value(v, k) for k, v in doc.iteritems()))
+        xml.append(u'</result>')
+    for name, value in body.iteritems():
+        if name not in ('responseHeader', 'response'):
+            xml.append(_xml_value(value, name))
+    xml.append(u'</response>')
+    return u''.join(xml).encode('utf-8')
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # responses go out in one write
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('')
+
+    def do_POST(self):
+        self._handle(self._read_body())
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if not size:
+                    # trailers end with an empty line
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _handle(self, body):
+        tic = time.time()
+        path, _, query = self.path.partition('?')
+        params = urlparse.parse_qs(query)
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params.update(urlparse.parse_qs(body))
+            body = ''
+        params = dict((k, [v.decode('utf-8') for v in vs]) for k, vs in params.iteritems())
+
+        index = self.server.index
+        try:
+            if path.endswith('/update/json') or (path.endswith('/update') and 'json' in content_type):
+                self._update_json(index, body)
+                result = {}
+            elif path.endswith('/update'):
+                self._update_xml(index, body)
+                result = {}
+            elif path.endswith('/hashq') or (path.endswith('/select') and params.get('qt') == ['/hashq']):
+                result = self._hashq(index, params)
+            elif path.endswith('/select'):
+                result = self._select(index, params)
+            else:
+                self._respond(404, 'text/plain; charset=utf-8', 'No handler for %s' % path)
+                return
+            if params.get('commit', ['false'])[0] == 'true':
+                index.commit()
+        except (LocalSolrException, ValueError, SyntaxError) as e:
+            self._respond(400, 'text/plain; charset=utf-8', str(e))
+            return
+
+        response = {'responseHeader': {'status': 0, 'QTime': int((time.time() - tic) * 1000)}}
+        response.update(result)
+        if params.get('wt', ['standard'])[0] == 'json':
+            self._respond(200, 'application/json; charset=utf-8', json.dumps(response))
+        else:
+            self._respond(200, 'application/xml; charset=utf-8', to_xml(response))
+
+    def _respond(self, status, content_type, data):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _update_xml(self, index, body):
+        # batches are several commands in a row, <add>...</add><commit/>
+        for command in cElementTree.fromstring('<update>%s</update>' % body):
+            if command.tag == 'add':
+                for doc in command.iter('doc'):
+                    fields = {}
+                    for field in doc.iter('field'):
+                        name, value = field.get('name'), field.text or u''
+                        if name in fields:
+                            if not isinstance(fields[name], list):
+                                fields[name] = [fields[name]]
+                            fields[name].append(value)
+                        else:
+                            fields[name] = value
+                    index.add(fields)
+            elif command.tag == 'delete':
+                for element in command:
+                    if element.tag == 'id':
+                        index.delete_id(element.text)
+                    elif element.tag == 'query':
+                        index.delete_query(element.text)
+            elif command.tag in ('commit', 'optimize'):
+                index.commit()
+            else:
+                raise LocalSolrException('Unknown update command <%s>' % command.tag)
+
+    def _update_json(self, index, body):
+        commands = json.loads(body) if body.strip() else []
+        if isinstance(commands, list):
+            commands = {'add': [{'doc': doc} for doc in commands]}
+        for name, value in commands.iteritems():
+            values = value if isinstance(value, list) else [value]
+            for value in values:
+                if name == 'add':
+                    index.add(value['doc'])
+                elif name == 'delete':
+                    if 'id' in value:
+                        index.delete_id(value['id'])
+                    else:
+                        index.delete_query(value['query'])
+                elif name not in ('commit', 'optimize'):
+                    raise LocalSolrException('Unknown update command %s' % name)
+        if 'commit' in commands or 'optimize' in commands:
+            index.commit()
+
+    def _select(self, index, params):
+        def param(name, default=None):
+            return params.get(name, [default])[0]
+
+        docs, found, cursor = index.select(
+            param('q', '*:*'), fq=params.get('fq', []), fl=param('fl', '*'),
+            rows=int(param('rows', 10)), start=int(param('start', 0)),
+            sort=param('sort'), cursor=param('cursorMark')
+        )
+        result = {'response': {'numFound': found, 'start': int(param('start', 0)), 'docs': docs}}
+        if cursor is not None:
+            result['nextCursorMark'] = cursor
+        return result
+
+    def _hashq(self, index, params):
+        docs, found = index.hashq(params['q'][0].encode('ascii'),
+                                  fl=params.get('fl', ['*'])[0],
+                                  rows=int(params.get('rows', [10])[0]))
+        return {'response': {'numFound': found, 'start': 0, 'docs': docs}}
+
+
+class LocalSolrServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves a `LocalIndex` (a new one by default) under any path, a
+        request to <path>/select is a query of the core at <path>. """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 8502), index=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.index = index if index is not None else LocalIndex()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/solr/fp' % (host, port)
+
+    def start(self):
+        """ Serves in a daemon thread, returns the url of the core. """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        """ Stops serving started with `start` and closes the socket. """
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
@@ -152,48 +152,116 @@ def _tDouble(code, key, integ, fract):
     ]
 
 
-def socksend(sock, lst):
-    sock.sendall(''.join(lst))
+# outgoing data is joined to writes of at most this size (unless a single
+# string is larger), the size of the receive buffer of a SocketReader
+BUFFER_SIZE = 64 * 1024
 
 
-def sockrecv(sock, bytes):
-    d = ''
-    while len(d) < bytes:
-        c = sock.recv(min(8192, bytes - len(d)))
-        if not c:
+def socksend(sock, lst):
+    batch = []
+    size = 0
+    for s in lst:
+        if size and size + len(s) > BUFFER_SIZE:
+            sock.sendall(''.join(batch))
+            batch = []
+            size = 0
+        batch.append(s)
+        size += len(s)
+    if batch:
+        sock.sendall(''.join(batch))
+
+
+class SocketReader(object):
+    """
+    Reads from a socket through a reusable buffer: recv_into fills as much
+    of it as the socket has ready, the length prefixed frames of a response
+    are then parsed out of it without further syscalls. Values larger than
+    the buffer are received straight into a buffer of their own.
+    """
+    def __init__(self, sock, size=BUFFER_SIZE):
+        self.sock = sock
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        # unread data is _buf[_start:_end]
+        self._start = 0
+        self._end = 0
+
+    def _recv_into(self, view):
+        received = self.sock.recv_into(view)
+        if not received:
             raise TyrantError('Connection closed')
-        d += c
-    return d
-
-
-def socksuccess(sock):
-    fail_code = ord(sockrecv(sock, 1))
+        return received
+
+    def _fill(self, bytes):
+        """ Buffers at least `bytes` (at most the buffer size) bytes. """
+        available = self._end - self._start
+        if available >= bytes:
+            return
+        if self._start + bytes > len(self._buf):
+            # move the unread data to the front to make room
+            self._buf[:available] = self._buf[self._start:self._end]
+            self._start, self._end = 0, available
+        while self._end - self._start < bytes:
+            self._end += self._recv_into(self._view[self._end:])
+
+    def read(self, bytes):
+        if bytes > len(self._buf):
+            return self._read_large(bytes)
+        self._fill(bytes)
+        start = self._start
+        self._start += bytes
+        return self._view[start:self._start].tobytes()
+
+    def _read_large(self, bytes):
+        data = bytearray(bytes)
+        view = memoryview(data)
+        available = self._end - self._start
+        view[:available] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        while available < bytes:
+            available += self._recv_into(view[available:])
+        return str(data)
+
+    def unpack(self, fmt):
+        """ Reads a struct of the (fixed size) format `fmt`. """
+        size = struct.calcsize(fmt)
+        self._fill(size)
+        values = struct.unpack_from(fmt, self._buf, self._start)
+        self._start += size
+        return values
+
+
+def sockrecv(reader, bytes):
+    return reader.read(bytes)
+
+
+def socksuccess(reader):
+    fail_code = reader.unpack('>B')[0]
     if fail_code:
         raise TyrantError(fail_code)
 
 
-def socklen(sock):
-    return struct.unpack('>I', sockrecv(sock, 4))[0]
+def socklen(reader):
+    return reader.unpack('>I')[0]
 
 
-def socklong(sock):
-    return struct.unpack('>Q', sockrecv(sock, 8))[0]
+def socklong(reader):
+    return reader.unpack('>Q')[0]
 
 
-def sockstr(sock):
-    return sockrecv(sock, socklen(sock))
+def sockstr(reader):
+    return reader.read(socklen(reader))
 
 
-def sockdouble(sock):
-    intpart, fracpart = struct.unpack('>QQ', sockrecv(sock, 16))
+def sockdouble(reader):
+    intpart, fracpart = reader.unpack('>QQ')
     return intpart + (fracpart * 1e-12)
 
 
-def sockstrpair(sock):
-    klen = socklen(sock)
-    vlen = socklen(sock)
-    k = sockrecv(sock, klen)
-    v = sockrecv(sock, vlen)
+def sockstrpair(reader):
+    klen, vlen = reader.unpack('>II')
+    k = reader.read(klen)
+    v = reader.read(vlen)
     return k, v
 
 
@@ -349,6 +417,7 @@ class Tyrant(object):
 
     def __init__(self, sock):
         self.sock = sock
+        self.reader = SocketReader(sock)
 
     def close(self):
         self.sock.close()
@@ -357,20 +426,20 @@ class Tyrant(object):
         """Unconditionally set key to value
         """
         socksend(self.sock, _t2(C.put, key, value))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def putkeep(self, key, value):
         """Set key to value if key does not already exist
         """
         socksend(self.sock, _t2(C.putkeep, key, value))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def putcat(self, key, value):
         """Append value to the existing value for key, or set key to
         value if it does not already exist
         """
         socksend(self.sock, _t2(C.putcat, key, value))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def putshl(self, key, value, width):
         """Equivalent to::
@@ -379,7 +448,7 @@ class Tyrant(object):
             self.put(key, self.get(key)[-width:])
         """
         socksend(self.sock, _t2W(C.putshl, key, value, width))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def putnr(self, key, value):
         """Set key to value without waiting for a server response
@@ -390,21 +459,21 @@ class Tyrant(object):
         """Remove key from server
         """
         socksend(self.sock, _t1(C.out, key))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def get(self, key):
         """Get the value of a key from the server
         """
         socksend(self.sock, _t1(C.get, key))
-        socksuccess(self.sock)
-        return sockstr(self.sock)
+        socksuccess(self.reader)
+        return sockstr(self.reader)
 
     def _mget(self, klst):
         socksend(self.sock, _tN(C.mget, klst))
-        socksuccess(self.sock)
-        numrecs = socklen(self.sock)
+        socksuccess(self.reader)
+        numrecs = socklen(self.reader)
         for i in xrange(numrecs):
-            k, v = sockstrpair(self.sock)
+            k, v = sockstrpair(self.reader)
             yield k, v
 
     def mget(self, klst):
@@ -416,28 +485,28 @@ class Tyrant(object):
         """Get the size of a value for key
         """
         socksend(self.sock, _t1(C.vsiz, key))
-        socksuccess(self.sock)
-        return socklen(self.sock)
+        socksuccess(self.reader)
+        return socklen(self.reader)
 
     def iterinit(self):
         """Begin iteration over all keys of the database
         """
         socksend(self.sock, _t0(C.iterinit))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def iternext(self):
         """Get the next key after iterinit
         """
         socksend(self.sock, _t0(C.iternext))
-        socksuccess(self.sock)
-        return sockstr(self.sock)
+        socksuccess(self.reader)
+        return sockstr(self.reader)
 
     def _fwmkeys(self, prefix, maxkeys):
         socksend(self.sock, _t1M(C.fwmkeys, prefix, maxkeys))
-        socksuccess(self.sock)
-        numkeys = socklen(self.sock)
+        socksuccess(self.reader)
+        numkeys = socklen(self.reader)
         for i in xrange(numkeys):
-            yield sockstr(self.sock)
+            yield sockstr(self.reader)
 
     def fwmkeys(self, prefix, maxkeys):
         """Get up to the first maxkeys starting with prefix
@@ -446,15 +515,15 @@ class Tyrant(object):
 
     def addint(self, key, num):
         socksend(self.sock, _t1M(C.addint, key, num))
-        socksuccess(self.sock)
-        return socklen(self.sock)
+        socksuccess(self.reader)
+        return socklen(self.reader)
 
     def adddouble(self, key, num):
         fracpart, intpart = math.modf(num)
         fracpart, intpart = int(fracpart * 1e12), int(intpart)
         socksend(self.sock, _tDouble(C.adddouble, key, fracpart, intpart))
-        socksuccess(self.sock)
-        return sockdouble(self.sock)
+        socksuccess(self.reader)
+        return sockdouble(self.reader)
 
     def ext(self, func, opts, key, value):
         # tcrdbext opts are RDBXOLCKREC, RDBXOLCKGLB
@@ -463,69 +532,69 @@ class Tyrant(object):
         opts is a bitflag that can be RDBXOLCKREC for record locking
         and/or RDBXOLCKGLB for global locking"""
         socksend(self.sock, _t3F(C.ext, func, opts, key, value))
-        socksuccess(self.sock)
-        return sockstr(self.sock)
+        socksuccess(self.reader)
+        return sockstr(self.reader)
 
     def sync(self):
         """Synchronize the database
         """
         socksend(self.sock, _t0(C.sync))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def vanish(self):
         """Remove all records
         """
         socksend(self.sock, _t0(C.vanish))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def copy(self, path):
         """Hot-copy the database to path
         """
         socksend(self.sock, _t1(C.copy, path))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def restore(self, path, msec):
         """Restore the database from path at timestamp (in msec)
         """
         socksend(self.sock, _t1R(C.copy, path, msec))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def setmst(self, host, port):
         """Set master to host:port
         """
         socksend(self.sock, _t1M(C.setmst, host, port))
-        socksuccess(self.sock)
+        socksuccess(self.reader)
 
     def rnum(self):
         """Get the number of records in the database
         """
         socksend(self.sock, _t0(C.rnum))
-        socksuccess(self.sock)
-        return socklong(self.sock)
+        socksuccess(self.reader)
+        return socklong(self.reader)
 
     def size(self):
         """Get the size of the database
         """
         socksend(self.sock, _t0(C.size))
-        socksuccess(self.sock)
-        return socklong(self.sock)
+        socksuccess(self.reader)
+        return socklong(self.reader)
 
     def stat(self):
         """Get some statistics about the database
         """
         socksend(self.sock, _t0(C.stat))
-        socksuccess(self.sock)
-        return sockstr(self.sock)
+        socksuccess(self.reader)
+        return sockstr(self.reader)
 
     def _misc(self, func, opts, args):
         # tcrdbmisc opts are RDBMONOULOG
         socksend(self.sock, _t1FN(C.misc, func, opts, args))
         try:
-            socksuccess(self.sock)
+            socksuccess(self.reader)
         finally:
-            numrecs = socklen(self.sock)
+            numrecs = socklen(self.reader)
         for i in xrange(numrecs):
-            yield sockstr(self.sock)
+            yield sockstr(self.reader)
 
     def misc(self, func, opts, args):
         """All databases support "putlist", "outlist", and "getlist".
@@ -94,6 +94,14 @@ Once created, a connection object has the following public methods:
 
             Returns a Response object
 
+    stream_query(q, fields=None, sort=None, unique_key='id',
+                 block_size=1000, **params)
+
+            A generator of all documents matching q, fetched block_size
+            at a time with cursor paging (Solr 4.7+), every block costs
+            the same no matter how deep it is. The sort has to end with
+            the unique key, it's appended if it's missing.
+
     add(**params)
     
             Add a document.  Pass in all document fields as 
@@ -113,6 +121,8 @@ Once created, a connection object has the following public methods:
                 add_many( [ {'id': 'foo1', 'notes': 'foo'}, 
                             {'id': 'foo2', 'notes': 'w00t'} ] )
             
+            With use_json=True the documents are streamed as JSON
+            and batch_size limits the documents sent per request.
             You must "commit" for the addition to be saved.
             This command honors begin_batch/end_batch.
             
@@ -284,13 +294,20 @@ Enter a raw query, without processing the returned HTML contents.
 
 """
 import sys
+import re
+import select
 import socket
+import threading
 import httplib
 import urlparse
 import codecs
 import urllib
 import datetime
+import itertools
+import logging
+import random
 import time
+import zlib
 from StringIO import StringIO
 from xml.sax import make_parser
 from xml.sax import _exceptions
@@ -299,13 +316,35 @@ from xml.sax.saxutils import escape, quoteattr
 from xml.dom.minidom import parseString
 from types import BooleanType, FloatType, IntType, ListType, LongType, StringType, UnicodeType
 from contextlib import contextmanager
-import Queue
+import collections
+
+import stats
+
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 
 __version__ = "1.3.0"
 
 __all__ = ['SolrException', 'SolrHTTPException', 'SolrContentException',
-           'SolrConnection', 'Response']
+           'SolrPoolTimeoutException', 'SolrTimeoutException', 'RetryPolicy',
+           'SolrConnection', 'SolrConnectionPool', 'SolrReplicaPool', 'Response']
+
+
+logger = logging.getLogger(__name__)
+
+
+# control characters XML doesn't allow (all of 0x00-0x1F but 0x09, 0x0A, 0x0D)
+_INVALID_XML_CHARS = ''.join(chr(c) for c in range(0x20) if c not in (0x09, 0x0A, 0x0D))
+_INVALID_XML_RE = re.compile('[%s]' % re.escape(_INVALID_XML_CHARS))
+
+# size of the chunks JSON updates are streamed in
+JSON_CHUNK_SIZE = 64 * 1024
+# documents per JSON update request if no batch size is set, every
+# batch is held in memory to send it again if the request is retried
+JSON_BATCH_SIZE = 1000
 
 
 
@@ -324,46 +363,321 @@ def pooled_connection(pool):
     conn = pool.get()
     try:
         yield conn
-    except Exception:
+    except BaseException as e:
+        # the connection may be in any state, close it and free its slot
+        # (also if a generator using it is closed, GeneratorExit)
+        pool.discard(conn, e)
         raise
     else:
-        # only return connection to pool if an exception wasn't raised
         pool.put(conn)
 
 class ConnectionPool(object):
-    "Thread-safe connection pool."
+    "Thread-safe connection pool with a maximum size."
     
     def __init__(self, klass, *args, **kwargs):
         """
         Initialize a new connection pool, where klass is the connection class.
         Provide any addition args or kwargs to pass during initialization of new connections.
         
-        If a kwarg named pool_size is provided, it will dictate the maximum number of connections to retain in the pool.
-        If none is provided, it will default to 20.
+        If a kwarg named pool_size is provided, it will dictate the maximum number of connections
+        open at once (in use or idle in the pool). If none is provided, it will default to 20.
+
+        pool_timeout is the number of seconds get waits for a connection if all are in use,
+        defaults to 30. None waits forever.
+
+        pool_max_idle closes connections which were idle for more seconds, defaults to 60.
         """
         self._args = args
         self._kwargs = kwargs
-        self._queue = Queue.Queue(self._kwargs.pop('pool_size', 20))
         self._klass = klass
+        self.max_size = self._kwargs.pop('pool_size', 20)
+        self.timeout = self._kwargs.pop('pool_timeout', 30)
+        self.max_idle = self._kwargs.pop('pool_max_idle', 60)
+
+        # (connection, returned at), the most recently returned last
+        self._idle = collections.deque()
+        self._open = 0
+        self._in_use = 0
+        # a threading lock, cooperative if gevent patched threading
+        self._cond = threading.Condition()
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_ms = stats.RollingHistogram()
     
     def get(self):
-        "Get an available connection, creating a new one if needed."
-        try:
-            return self._queue.get_nowait()
-        except Queue.Empty:
-            return self._klass(*self._args, **self._kwargs)
-    
+        """
+        Get an available connection, creating a new one if less than pool_size are open.
+        Otherwise waits up to pool_timeout seconds for one to be returned and raises
+        SolrPoolTimeoutException if none is.
+        """
+        tic = time.time()
+        deadline = None
+        if self.timeout is not None:
+            deadline = tic + self.timeout
+
+        while True:
+            conn = self._checkout(deadline)
+            if conn is None:
+                try:
+                    conn = self._klass(*self._args, **self._kwargs)
+                except Exception:
+                    self._release()
+                    raise
+                break
+            if self.check(conn):
+                break
+            self.discard(conn)
+
+        self.wait_ms.add((time.time() - tic) * 1000)
+        return conn
+
+    def _checkout(self, deadline):
+        """
+        Takes an idle connection, returns None if a new one may be opened.
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                self._evict(now)
+                if self._idle or self._open < self.max_size:
+                    break
+                if deadline is not None and now >= deadline:
+                    self.timeouts += 1
+                    raise SolrPoolTimeoutException(
+                        None, "No connection free after %ss" % self.timeout)
+                self._cond.wait(None if deadline is None else deadline - now)
+
+            self.checkouts += 1
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()[0]
+            self._open += 1
+            return None
+
+    def _evict(self, now):
+        # the least recently returned connections are at the front
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.popleft()
+            self._open -= 1
+            self.close(conn)
+
+    def _release(self):
+        with self._cond:
+            self._open -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
     def put(self, conn):
         "Return a connection to the pool."
-        try:
-            self._queue.put_nowait(conn)
-        except Queue.Full:
-            pass
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def discard(self, conn, error=None):
+        "Close a checked out connection instead of returning it, `error` is what went wrong."
+        self.close(conn)
+        self._release()
+
+    def check(self, conn):
+        "Whether an idle connection can be reused."
+        return True
+
+    def close(self, conn):
+        close = getattr(conn, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+
+    def stats(self):
+        """
+        Returns {'max_size': n, 'open': n, 'in_use': n, 'idle': n, 'checkouts': n,
+        'timeouts': n, 'wait_ms': {'count': n, 'p50': ms, 'p95': ms, 'p99': ms}}
+        """
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'open': self._open,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_ms': self.wait_ms.summary()
+            }
 
 class SolrConnectionPool(ConnectionPool):
     def __init__(self, url, **kwargs):
+        # shared by all connections of the pool
+        self.request_stats = kwargs.setdefault('request_stats', stats.LatencyStats())
         ConnectionPool.__init__(self, SolrConnection, url, **kwargs)
 
+    def stats(self):
+        """
+        ConnectionPool.stats and 'requests', the request_stats of the
+        connections: {'request_bytes': {'count': n, 'p50': n, ...}, ...}
+        """
+        result = ConnectionPool.stats(self)
+        result['requests'] = self.request_stats.stats()
+        return result
+
+    def check(self, conn):
+        """
+        An idle connection is reused unless its socket became readable,
+        Solr closed it (or sent something unexpected) in the meantime.
+        """
+        sock = conn.conn.sock
+        if sock is None:
+            # not connected, connects on the next request
+            return True
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+
+class _Replica(object):
+    def __init__(self, url, pool):
+        self.url = url
+        self.pool = pool
+        # smoothed request latency in ms, None until the first request
+        self.latency = None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        # consecutive failed requests
+        self.failures = 0
+        self.ejected_until = None
+        self.eject_time = 0
+        self.probing = False
+
+    def stats(self):
+        return {
+            'latency_ms': self.latency,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'ejected': self.ejected_until is not None,
+            'pool': self.pool.stats()
+        }
+
+
+class SolrReplicaPool(object):
+    """
+    Balances connections across the replicas of an index. Every request goes
+    to the healthy replica with the lowest expected latency, the smoothed
+    (EWMA) latency of its requests times its requests in flight + 1.
+
+    A replica failing `max_failures` requests in a row (with an error its
+    retry policy would retry or SolrTimeoutException) is ejected for
+    `eject_time` seconds, after that a single request probes it. If the
+    probe fails it's ejected again for twice as long (at most
+    `max_eject_time`), if it succeeds it's back in rotation.
+
+    Every replica has its own ConnectionPool, the kwargs (including
+    pool_size, pool_timeout and pool_max_idle) are passed to all of them.
+    Works with pooled_connection like a ConnectionPool.
+    """
+    def __init__(self, urls, max_failures=3, eject_time=5, max_eject_time=60, alpha=0.3, **kwargs):
+        if not urls:
+            raise ValueError("At least one replica URL is required")
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.alpha = alpha
+        self._retry_policy = kwargs.get('retry_policy') or RetryPolicy()
+        self.replicas = [_Replica(url, SolrConnectionPool(url, **dict(kwargs))) for url in urls]
+        # connection -> (replica, checked out at)
+        self._checked_out = {}
+        self._lock = threading.Lock()
+
+    def _choose(self, now):
+        with self._lock:
+            candidates = []
+            for replica in self.replicas:
+                if replica.ejected_until is None:
+                    candidates.append(replica)
+                elif now >= replica.ejected_until and not replica.probing:
+                    # one request probes the replica
+                    replica.probing = True
+                    replica.in_flight += 1
+                    return replica
+
+            if not candidates:
+                # all are ejected, rather try the one back the soonest than fail
+                candidates = [min(self.replicas, key=lambda r: r.ejected_until)]
+
+            replica = min(candidates, key=lambda r: (r.latency or 0) * (r.in_flight + 1))
+            replica.in_flight += 1
+            return replica
+
+    def get(self):
+        replica = self._choose(time.time())
+        try:
+            conn = replica.pool.get()
+        except Exception as e:
+            self._done(replica, None, e)
+            raise
+        with self._lock:
+            self._checked_out[conn] = (replica, time.time())
+        return conn
+
+    def put(self, conn):
+        with self._lock:
+            replica, tic = self._checked_out.pop(conn)
+        replica.pool.put(conn)
+        self._done(replica, (time.time() - tic) * 1000, None)
+
+    def discard(self, conn, error=None):
+        with self._lock:
+            replica, tic = self._checked_out.pop(conn)
+        replica.pool.discard(conn, error)
+        self._done(replica, (time.time() - tic) * 1000, error)
+
+    def _failed(self, error):
+        return isinstance(error, SolrTimeoutException) or self._retry_policy.retryable(error)
+
+    def _done(self, replica, ms, error):
+        with self._lock:
+            replica.in_flight -= 1
+            probing, replica.probing = replica.probing, False
+            if isinstance(error, SolrPoolTimeoutException):
+                # busy, which says nothing about its health
+                return
+            replica.requests += 1
+
+            if error is not None and self._failed(error):
+                replica.errors += 1
+                replica.failures += 1
+                if probing or replica.failures >= self.max_failures:
+                    replica.eject_time = min(self.max_eject_time, replica.eject_time * 2 or self.eject_time)
+                    replica.ejected_until = time.time() + replica.eject_time
+                    logger.warning("Ejecting Solr replica %s for %ss after %r",
+                                   replica.url, replica.eject_time, error)
+                return
+
+            if replica.ejected_until is not None:
+                logger.warning("Solr replica %s is back", replica.url)
+            replica.failures = 0
+            replica.ejected_until = None
+            replica.eject_time = 0
+            if ms is not None:
+                if replica.latency is None:
+                    replica.latency = ms
+                else:
+                    replica.latency += self.alpha * (ms - replica.latency)
+
+    def stats(self):
+        """
+        Returns {url: {'latency_ms': ms, 'in_flight': n, 'requests': n, 'errors': n,
+        'ejected': bool, 'pool': ConnectionPool.stats()}}
+        """
+        with self._lock:
+            return collections.OrderedDict((r.url, r.stats()) for r in self.replicas)
+
     
 def str2bool(s):
     if(isinstance(s,bool)):
@@ -435,6 +749,70 @@ class SolrHTTPException(SolrException):
 class SolrContentException(SolrException):
     pass
 
+class SolrPoolTimeoutException(SolrException):
+    pass
+
+class SolrTimeoutException(SolrException):
+    """ The retry policy gave up on a request, `error` is the last error. """
+    def __init__(self, reason, error=None):
+        SolrException.__init__(self, None, reason)
+        self.error = error
+
+
+class RetryPolicy(object):
+    """
+    How SolrConnection retries failed requests.
+
+        max_attempts -- Attempts per request, including the first.
+
+        backoff, max_backoff -- The delay before the n-th retry is random
+            (full jitter) between 0 and backoff * 2 ** (n - 1) seconds,
+            but at most max_backoff seconds.
+
+        deadline -- Seconds all attempts of a request may take, every
+            attempt gets the remaining time as its socket timeout. Once
+            it's used up (or the next retry would start later)
+            SolrTimeoutException is raised. Meant for queries, commits
+            and optimizes on a big index may take long. By default
+            (None) requests are retried until max_attempts is reached,
+            with the connection's own timeout.
+
+        retry_on -- The exceptions which are retried. SolrHTTPExceptions
+            are only retried for 5xx responses.
+
+    The delays are slept with time.sleep, which is cooperative once gevent
+    patched it (it's looked up on every call, so patching after the import
+    works too).
+    """
+    # BadStatusLine is spurious and may randomly happen on an
+    # otherwise fine SOLR connection (though not often)
+    RETRY_ON = (SolrHTTPException, httplib.ImproperConnectionState,
+                httplib.BadStatusLine, socket.error)
+
+    def __init__(self, max_attempts=4, backoff=0.5, max_backoff=5, deadline=None, retry_on=RETRY_ON):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.retry_on = retry_on
+
+    def retryable(self, e):
+        if not isinstance(e, self.retry_on):
+            return False
+        if isinstance(e, SolrHTTPException) and e.httpcode is not None:
+            # the same request will fail again
+            return e.httpcode >= 500
+        return True
+
+    def delay(self, attempt):
+        """ The delay in seconds after the `attempt`th failed attempt. """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
 # ===================================================================
 # Connection Object
 # ===================================================================
@@ -453,7 +831,13 @@ class SolrConnection:
                  ssl_key=None, 
                  ssl_cert=None,
                  invariant="",
-                 post_headers={}):
+                 post_headers={},
+                 json_updates=False,
+                 update_batch_size=None,
+                 retry_policy=None,
+                 gzip_responses=True,
+                 compress_requests=None,
+                 request_stats=None):
 
         """
             url -- URI pointing to the SOLR instance. Examples:
@@ -475,6 +859,34 @@ class SolrConnection:
                 SSL authentication,  these should be, respectively, 
                 your PEM key file and certificate file
 
+            json_updates -- Send the documents of add_many as JSON,
+                streamed with chunked transfer encoding, instead of XML.
+                Requires Solr 3.1+ (the JSON update handler).
+                Defaults to false
+
+            update_batch_size -- Send at most this many documents of
+                add_many per request. By default all are sent at once
+                as XML and in batches of JSON_BATCH_SIZE as JSON.
+
+            retry_policy -- A RetryPolicy, how failed requests are
+                retried. Defaults to RetryPolicy().
+
+            gzip_responses -- Ask Solr for gzip compressed responses,
+                Solr (its servlet container) may still send them
+                uncompressed. Defaults to true
+
+            compress_requests -- gzip request bodies of at least this many
+                bytes (but not streamed JSON updates). Solr only accepts
+                them if its servlet container inflates requests, e.g.
+                Jetty's GzipHandler. By default requests aren't compressed.
+
+            request_stats -- A stats.LatencyStats every request is recorded
+                in: request_bytes and response_bytes (on the wire),
+                response_size (decompressed) and ttfb_ms (from sending the
+                request until the response headers arrived). The numbers
+                of the last request are in `last_request`.
+
+
         """
 
                 
@@ -489,6 +901,13 @@ class SolrConnection:
         self.ssl_key = ssl_key
         self.ssl_cert = ssl_cert
         self.invariant = invariant
+        self.json_updates = json_updates
+        self.update_batch_size = update_batch_size
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.gzip_responses = gzip_responses
+        self.compress_requests = compress_requests
+        self.request_stats = request_stats
+        self.last_request = None
         
         if self.scheme == 'https': 
             self.conn = httplib.HTTPSConnection(self.host, 
@@ -513,6 +932,11 @@ class SolrConnection:
         if not self.persistent: 
             self.xmlheaders['Connection'] = 'close'
 
+        self.json_update_headers = {'Content-Type': 'application/json; charset=utf-8'}
+        self.json_update_headers.update(post_headers)
+        if not self.persistent: 
+            self.json_update_headers['Connection'] = 'close'
+
         self.form_headers = {
                 'Content-Type': 
                 'application/x-www-form-urlencoded; charset=utf-8'}
@@ -561,6 +985,27 @@ class SolrConnection:
         #else: 
         #    return None
 
+    def parse_query_response_json(self, data, params, connection):
+        """
+        Parse the wt=json results of a /select call into the
+        same Response the XML parser returns, dates are not
+        converted and stay strings.
+        """
+        data = json.loads(data)
+
+        response = Response(connection)
+        response.header = data.pop('responseHeader', {})
+        result = data.pop('response', {})
+        response.results = Results(result.pop('docs', []))
+        for name, value in result.items():
+            setattr(response.results, name, value)
+        for name, value in data.items():
+            setattr(response, name, value)
+
+        response._params = params
+        response._connection = connection
+        return response
+
     def smartQuery(self, query, fq='', fields='name,id', sort='',limit=0, start=0, blockSize=1000,callback=None):
         "Queries the server with blocks"
         docs = []
@@ -569,7 +1014,7 @@ class SolrConnection:
         if(limit<blockSize):
             blockSize=limit
         for startAt in range(start,limit,blockSize):
-            sys.stderr.write(str(startAt)+ ' ')
+            logger.debug("Querying from %d", startAt)
             response = self.query(query, fields=fields,rows=blockSize, start=startAt, sort=sort, fq=fq)
             if len(response) == 0:
                 break
@@ -578,11 +1023,51 @@ class SolrConnection:
             else:
                 for r in response:
                     docs.append(r)
-        sys.stderr.write('\n')
         return docs
 
+    def stream_query(self, q, fields=None, sort=None, unique_key='id', block_size=1000, **params):
+        """
+        Yields all documents matching q, block_size at a time.
+
+        Unlike paging with start (smartQuery, Response.next_batch) Solr
+        doesn't collect and skip all previous documents for every block
+        but continues after the cursor mark of the last one, so scanning
+        the whole index is linear and only one block is held in memory.
+        Requires Solr 4.7+.
+
+        sort is a list of fields to sort by (see query), it has to be
+        unique so unique_key (the uniqueKey of the schema) is added as
+        last sort field if it's missing. fields and the other params are
+        passed on to query, start can't be used.
+        """
+        if not sort:
+            sort = []
+        elif isinstance(sort, basestring):
+            sort = [f.strip() for f in sort.split(',')]
+        else:
+            sort = list(sort)
+        if unique_key not in [f.split()[0] for f in sort]:
+            sort.append('%s asc' % unique_key)
+
+        cursor = '*'
+        while True:
+            response = self.query(q, fields=fields, score=False, sort=sort, rows=block_size,
+                                  cursorMark=cursor, use_json_parser=True, **params)
+            for doc in response.results:
+                yield doc
+
+            next_cursor = getattr(response, 'nextCursorMark', None)
+            if next_cursor is None:
+                # older versions ignore cursorMark and return the first block again and again
+                raise SolrContentException(None, "No nextCursorMark in the response, Solr 4.7+ is required")
+            # the cursor doesn't move once all documents are returned
+            if not response.results or next_cursor == cursor:
+                return
+            cursor = next_cursor
+
     def query(self, q, fields=None, highlight=None, 
-              score=True, sort=None, use_experimental_parser=False, **params):
+              score=True, sort=None, use_experimental_parser=False,
+              use_json_parser=False, **params):
 
         """
         q is the query string.
@@ -605,6 +1090,10 @@ class SolrConnection:
         sort is a list of fields to sort by. See "fields" for
         formatting.
 
+        use_json_parser requests wt=json, it is decoded straight into
+        the result rows (without the XML cleanup), see
+        parse_query_response_json.
+
         Optional parameters can also be passed in.  Many SOLR
         parameters are in a dotted notation (e.g., hl.simple.post). 
         For such parameters, replace the dots with underscores when 
@@ -660,6 +1149,8 @@ class SolrConnection:
         params['version'] = self.response_version
         if(use_experimental_parser):
             params['wt']='python'
+        elif(use_json_parser):
+            params['wt'] = 'json'
         else:
             params['wt'] = 'standard'
 
@@ -675,6 +1166,8 @@ class SolrConnection:
             #xml = StringIO(self._cleanup(reallyUTF8(rsp.read())))
             tic=time.time()
             s1 = rsp.read()
+            if(use_json_parser):
+                return self.parse_query_response_json(s1, params=params, connection=self)
             s2 = reallyUTF8(s1)
             s3 = self._cleanup(s2)
 
@@ -781,21 +1274,52 @@ class SolrConnection:
         return self._update(xstr)
 
 
-    def add_many(self, docs, _commit=False, addHandler="/update"):
+    def add_many(self, docs, _commit=False, addHandler="/update", use_json=None, batch_size=None):
         """
         Add several documents to the SOLR server.
 
-        docs -- a list of dicts, where each dict is a document to add 
-            to SOLR.
+        docs -- a list (or any iterable) of dicts, where each dict is
+            a document to add to SOLR.
+
+        use_json -- Stream the documents as JSON to addHandler + '/json',
+            see the json_updates argument of the connection (the default).
+            Within begin_batch/end_batch the documents are always queued
+            as XML.
+
+        batch_size -- Send at most this many documents per request,
+            see the update_batch_size argument of the connection (the default).
+            JSON updates are sent in batches of JSON_BATCH_SIZE documents
+            if neither is set, so an iterable is never read at once.
         """
-        lst = [u'<add>']
-        for doc in docs:
-            self.__add(lst, doc)
-        lst.append(u'</add>')
-        if _commit: 
-            lst.append(u'<commit/>')
-        xstr = ''.join(lst)
-        return self._update(xstr, addHandler=addHandler)
+        if use_json is None:
+            use_json = self.json_updates
+        if batch_size is None:
+            batch_size = self.update_batch_size
+        if self.batch_cnt:
+            use_json = False
+        if use_json and not batch_size:
+            batch_size = JSON_BATCH_SIZE
+
+        if batch_size:
+            docs = iter(docs)
+            batches = iter(lambda: list(itertools.islice(docs, batch_size)), [])
+        else:
+            batches = [docs]
+
+        data = None
+        for batch in batches:
+            if use_json:
+                data = self._update_json(batch, addHandler=addHandler)
+            else:
+                lst = [u'<add>']
+                for doc in batch:
+                    self.__add(lst, doc)
+                lst.append(u'</add>')
+                data = self._update(''.join(lst), addHandler=addHandler)
+
+        if _commit:
+            data = self.commit()
+        return data
         
     
 
@@ -937,6 +1461,41 @@ class SolrConnection:
                 raise SolrHTTPException(rsp.status, reason)
         return data
 
+    def _update_json(self, docs, addHandler="/update"):
+        """
+        Streams `docs` as a JSON array to the JSON update handler,
+        serialized document by document while they are sent.
+        """
+        if not isinstance(docs, (list, tuple)):
+            # serialized again if the request is retried
+            docs = list(docs)
+
+        def chunks():
+            # documents are grouped to chunks of about JSON_CHUNK_SIZE bytes
+            chunk, size = ['['], 1
+            for i, doc in enumerate(docs):
+                if i:
+                    chunk.append(',')
+                data = json.dumps(_json_document(doc))
+                if isinstance(data, unicode):
+                    data = data.encode('utf-8')
+                chunk.append(data)
+                size += len(data) + 1
+                if size >= JSON_CHUNK_SIZE:
+                    yield ''.join(chunk)
+                    chunk, size = [], 0
+            chunk.append(']')
+            yield ''.join(chunk)
+
+        url = self.path + addHandler + '/json' + self.invariant
+        try:
+            rsp = self._post_chunked(url, chunks, self.json_update_headers)
+            data = rsp.read()
+        finally:
+            if not self.persistent: 
+                self.conn.close()
+        return data
+
     def __add(self, lst, fields):
         lst.append(u'<doc>')
         for field, value in fields.items():
@@ -971,84 +1530,183 @@ class SolrConnection:
             self.xmlheaders, self.reconnects)
 
 
+    def close(self):
+        self.conn.close()
+
+
     def _reconnect(self):
+        # the next request connects again, if Solr is down
+        # that request fails and is retried by the retry policy
         self.reconnects += 1
         self.conn.close()
-        try:
-            self.conn.connect()
-        except socket.error:
-            print "Error re-connecting. I'm going to wait one minute for solr to restart. If it doesn't come back there's a problem."
-            time.sleep(60)
-            self.conn.connect()
-            print "It re-connected ok."
 
 
     def _cleanup(self, body):
         # clean up the body
         #section 2.2 of the XML spec. Three characters from the 0x00-0x1F block are allowed: 0x09, 0x0A, 0x0D.
-        body = body.replace("\x00","")
-        body = body.replace("\x01","")
-        body = body.replace("\x02","")
-        body = body.replace("\x03","")
-        body = body.replace("\x04","")
-        body = body.replace("\x05","")
-        body = body.replace("\x06","")
-        body = body.replace("\x07","")
-        body = body.replace("\x08","")
-        body = body.replace("\x0b","")
-        body = body.replace("\x0c","")
-        body = body.replace("\x0e","")
-        body = body.replace("\x0f","")
-        body = body.replace("\x10","")
-        body = body.replace("\x11","")
-        body = body.replace("\x12","")
-        body = body.replace("\x13","")
-        body = body.replace("\x14","")
-        body = body.replace("\x15","")
-        body = body.replace("\x16","")
-        body = body.replace("\x17","")
-        body = body.replace("\x18","")
-        body = body.replace("\x19","")
-        body = body.replace("\x1A","")
-        body = body.replace("\x1B","")
-        body = body.replace("\x1C","")
-        body = body.replace("\x1D","")
-        body = body.replace("\x1E","")
-        body = body.replace("\x1F","")
-        return body
-        
+        # a single pass and copy, no matter how many characters are removed
+        if isinstance(body, unicode):
+            return _INVALID_XML_RE.sub(u'', body)
+        return body.translate(None, _INVALID_XML_CHARS)
+
     def _post(self, url, body, headers):
-        body = self._cleanup(body)
-        
-        maxattempts = attempts = 4
-        while attempts: 
-            caught_exception = False
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        # only XML can't contain control characters, form encoded
+        # bodies are escaped and JSON bodies escape them themselves.
+        # They are single bytes in UTF-8, so the encoded body is cleaned
+        if headers.get('Content-Type', '').startswith('text/xml'):
+            body = self._cleanup(body)
+
+        headers = self._negotiate(headers)
+        if self.compress_requests is not None and len(body) >= self.compress_requests:
+            compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+
+        def send():
+            self.conn.request('POST', url, body, headers)
+            return len(body)
+        return self._send(send)
+
+    def _negotiate(self, headers):
+        headers = dict(headers)
+        if self.gzip_responses:
+            headers['Accept-Encoding'] = 'gzip'
+        else:
+            headers['Accept-Encoding'] = 'identity'
+        return headers
+
+    def _post_chunked(self, url, chunks, headers):
+        """
+        POSTs the strings the generator function `chunks` yields with
+        chunked transfer encoding, the body is never held in memory
+        as a whole. `chunks` is called again for every attempt.
+        """
+        headers = self._negotiate(headers)
+
+        def send():
+            self.conn.putrequest('POST', url, skip_accept_encoding=True)
+            for header, value in headers.iteritems():
+                self.conn.putheader(header, value)
+            self.conn.putheader('Transfer-Encoding', 'chunked')
+            # the headers go out with the first chunk and the last chunk
+            # with the terminating one, small writes in a row are delayed
+            # by Nagle's algorithm until the server acknowledges them
+            headers_sent = False
+            pending = ''
+            sent = 0
+            for chunk in chunks():
+                if not chunk:
+                    continue
+                if pending:
+                    if headers_sent:
+                        self.conn.send(pending)
+                    else:
+                        self.conn.endheaders(pending)
+                        headers_sent = True
+                pending = '%x\r\n%s\r\n' % (len(chunk), chunk)
+                sent += len(chunk)
+            pending += '0\r\n\r\n'
+            if headers_sent:
+                self.conn.send(pending)
+            else:
+                self.conn.endheaders(pending)
+            return sent
+        return self._send(send)
+
+    def _send(self, send):
+        """
+        Sends a request with `send` (which returns the number of body
+        bytes it sent) and returns the response with its body read and
+        decompressed, reconnecting and retrying on connection errors as
+        long as the retry policy allows.
+        """
+        policy = self.retry_policy
+        tic = time.time()
+        attempt = 0
+        error = None
+        while True:
+            attempt += 1
+            timeout = self.timeout or socket.getdefaulttimeout()
+            if policy.deadline is not None:
+                remaining = policy.deadline - (time.time() - tic)
+                if remaining <= 0:
+                    raise SolrTimeoutException(
+                        "Gave up after %d attempts in %.1fs: %r" % (attempt - 1, time.time() - tic, error), error)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            self._set_timeout(timeout)
+
             try:
-                self.conn.request('POST', url, body.encode('utf-8'), headers)
-                return check_response_status(self.conn.getresponse())
-            except (SolrHTTPException,
-                    httplib.ImproperConnectionState,
-                    httplib.BadStatusLine):
-                    # We include BadStatusLine as they are spurious
-                    # and may randomly happen on an otherwise fine 
-                    # SOLR connection (though not often)
-                time.sleep(1)
-                caught_exception = True
-            except socket.error:
-                msg = "Connection error. %s tries left; retrying...\n" % attempts
-                sys.stderr.write(msg)
-                time.sleep(3 + 2 ** (maxattempts - attempts))
-                caught_exception = True
-            if caught_exception:    
-                self._reconnect()
-                attempts -= 1
-                if not attempts:
+                request_tic = time.time()
+                sent = send()
+                response = check_response_status(self.conn.getresponse())
+                ttfb = time.time() - request_tic
+                return self._read_response(response, sent, ttfb)
+            except Exception as e:
+                if not policy.retryable(e):
                     raise
+                error = e
+                self._reconnect()
+                if attempt >= policy.max_attempts:
+                    raise SolrTimeoutException(
+                        "Gave up after %d attempts in %.1fs: %r" % (attempt, time.time() - tic, e), e)
+
+                delay = policy.delay(attempt)
+                if policy.deadline is not None and time.time() + delay - tic > policy.deadline:
+                    raise SolrTimeoutException(
+                        "Gave up after %d attempts in %.1fs: %r" % (attempt, time.time() - tic, e), e)
+                logger.warning("Solr request failed (%r), retrying in %.2fs", e, delay)
+                policy.sleep(delay)
+
+    def _set_timeout(self, timeout):
+        """
+        Sets the socket timeout of the connection, of the open socket
+        and of the one it connects next.
+        """
+        self.conn.timeout = timeout
+        if self.conn.sock is not None:
+            self.conn.sock.settimeout(timeout)
+
+    def _read_response(self, response, sent, ttfb):
+        data = response.read()
+        received = len(data)
+        encoding = (response.getheader('content-encoding') or '').lower()
+        if encoding == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+        self.last_request = {
+            'request_bytes': sent,
+            'response_bytes': received,
+            'response_size': len(data),
+            'ttfb_ms': ttfb * 1000
+        }
+        if self.request_stats is not None:
+            self.request_stats.record(self.last_request)
+        return ReadResponse(response, data)
 
     
 # ===================================================================
 # Response objects
 # ===================================================================
+class ReadResponse(object):
+    """
+    A httplib.HTTPResponse with its (decompressed) body already read.
+    """
+    def __init__(self, response, data):
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self.getheader = response.getheader
+        self.getheaders = response.getheaders
+        self._body = StringIO(data)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._body.read()
+        return self._body.read(amt)
+
+
 class Response(object):
     """
     A container class for a 
@@ -1274,12 +1932,32 @@ def check_response_status(response):
         ex = SolrHTTPException(response.status, response.reason)
         try:
             ex.body = response.read()
+            if (response.getheader('content-encoding') or '').lower() == 'gzip':
+                ex.body = zlib.decompress(ex.body, 16 + zlib.MAX_WBITS)
         except:
             pass
         raise ex
     return response
 
 
+def _json_document(doc):
+    """Converts the values of a document JSON can't serialize (the same way __add does)."""
+    for value in doc.itervalues():
+        if isinstance(value, (datetime.datetime, list, tuple)):
+            break
+    else:
+        return doc
+
+    converted = {}
+    for field, value in doc.iteritems():
+        if isinstance(value, datetime.datetime):
+            value = utc_to_string(value)
+        elif isinstance(value, (list, tuple)):
+            value = [utc_to_string(v) if isinstance(v, datetime.datetime) else v for v in value]
+        converted[field] = value
+    return converted
+
+
 def stringToPython(f):
     """Convert a doc encoded as strings to native python types using EN's schema."""
     for key in f.keys():
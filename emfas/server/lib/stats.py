@@ -0,0 +1,80 @@
+"""
+Latency bookkeeping: per request stage timings and rolling
+histograms over the last requests.
+"""
+from contextlib import contextmanager
+import collections
+import threading
+import time
+
+
+class Timings(object):
+    """ Timings (in ms) of the stages of a single request. """
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        tic = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, (time.time() - tic) * 1000)
+
+    def add(self, name, ms):
+        self.stages[name] = self.stages.get(name, 0) + ms
+
+
+def _pick(samples, p):
+    return samples[int(round(p / 100.0 * (len(samples) - 1)))]
+
+
+class RollingHistogram(object):
+    """ Keeps the last `size` samples to calculate percentiles. """
+    def __init__(self, size=1000):
+        self._samples = collections.deque([], size)
+        self.count = 0
+
+    def add(self, value):
+        self._samples.append(value)
+        self.count += 1
+
+    def percentile(self, p):
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        return _pick(samples, p)
+
+    def summary(self):
+        samples = sorted(self._samples)
+        if not samples:
+            return {'count': self.count}
+
+        return {
+            'count': self.count,
+            'p50': _pick(samples, 50),
+            'p95': _pick(samples, 95),
+            'p99': _pick(samples, 99)
+        }
+
+
+class LatencyStats(object):
+    """ A rolling histogram per stage. """
+    def __init__(self, size=1000):
+        self.size = size
+        self._histograms = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, stages):
+        with self._lock:
+            for name, ms in stages.iteritems():
+                if name not in self._histograms:
+                    self._histograms[name] = RollingHistogram(self.size)
+                self._histograms[name].add(ms)
+
+    def stats(self):
+        """ Returns {stage: {'count': n, 'p50': ms, 'p95': ms, 'p99': ms}} """
+        with self._lock:
+            return collections.OrderedDict(
+                (name, h.summary()) for name, h in self._histograms.iteritems()
+            )
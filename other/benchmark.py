@@ -0,0 +1,292 @@
+"""
+Micro benchmarks for the fingerprint matching code.
+
+    python other/benchmark.py actual-matches --candidates 30
+    python other/benchmark.py codec --tracks 100
+    python other/benchmark.py solr-parse --rows 30
+    python other/benchmark.py solr-throughput --docs 2000
+    python other/benchmark.py tyrant-multi-get --keys 30
+"""
+import argparse
+import base64
+import json
+import random
+import socket
+import struct
+import threading
+import time
+import timeit
+import zlib
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+import emfas.server.lib.fp as fp
+import emfas.server.lib.localsolr as localsolr
+import emfas.server.lib.pytyrant as pytyrant
+import emfas.server.lib.solr as solr
+
+
+def random_code_string(n, duration, rnd):
+    pairs = sorted((rnd.randrange(duration), rnd.randrange(1 << 20)) for _ in xrange(n))
+    return ' '.join('%d %d' % (c, t) for t, c in pairs)
+
+
+def excerpt(code_string, start, end, rnd, noise=0.3):
+    """ Part of a code string, with some codes dropped and some random
+        codes added, like a recording of the track would look like. """
+    split = code_string.split()
+    pairs = [(int(t) - start, int(c)) for c, t in zip(split[::2], split[1::2])
+             if start <= int(t) < end and rnd.random() > noise]
+    pairs.extend((rnd.randrange(end - start), rnd.randrange(1 << 20)) for _ in xrange(len(pairs) / 3))
+    pairs.sort()
+    return ' '.join('%d %d' % (c, t) for t, c in pairs)
+
+
+def report(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print '{0:<30} {1:>10.3f}ms'.format(name, seconds * 1000)
+    return seconds
+
+
+def bench_actual_matches(ns):
+    rnd = random.Random(ns.seed)
+    # 60 second segments, 30s query
+    candidates = [random_code_string(ns.codes, 2586, rnd) for _ in xrange(ns.candidates)]
+    query = excerpt(candidates[0], 500, 1800, rnd)
+
+    for candidate in candidates:
+        expected = fp.actual_matches_python(query, candidate)
+        actual = fp.actual_matches(query, candidate)
+        assert expected == actual, (expected, actual)
+
+    def run(func):
+        return lambda: [func(query, c) for c in candidates]
+
+    def run_compiled():
+        compiled = fp.codes.CompiledQuery.from_string(query)
+        return [fp.actual_matches(compiled, c) for c in candidates]
+
+    print '{0} candidates, {1} codes each'.format(ns.candidates, ns.codes)
+    python = report('actual_matches_python', run(fp.actual_matches_python), ns.number)
+    numpy = report('actual_matches', run(fp.actual_matches), ns.number)
+    compiled = report('actual_matches (compiled)', run_compiled, ns.number)
+    print 'speedup: {0:.1f}x, {1:.1f}x compiled'.format(python / numpy, python / compiled)
+
+
+def compressed_code_string(n, duration, rnd):
+    """ A code like the codegen (and moomash dumps) compress them,
+        the times then the codes as 5 digit hex, zlib and base64. """
+    times = sorted(rnd.randrange(duration) for _ in xrange(n))
+    hash_codes = [rnd.randrange(1 << 20) for _ in xrange(n)]
+    inflated = ''.join('%05x' % t for t in times) + ''.join('%05x' % c for c in hash_codes)
+    return base64.urlsafe_b64encode(zlib.compress(inflated))
+
+
+def bench_codec(ns):
+    rnd = random.Random(ns.seed)
+    # a few minutes of audio per track
+    compressed = [compressed_code_string(ns.codes, 10000, rnd) for _ in xrange(ns.tracks)]
+    inflated = [zlib.decompress(base64.urlsafe_b64decode(c)) for c in compressed]
+
+    for s in inflated:
+        expected = fp.inflate_code_string_python(s)
+        actual = fp.inflate_code_string(s)
+        assert (expected.codes == actual.codes).all() and (expected.times == actual.times).all()
+
+    def decode_python(c):
+        return fp.inflate_code_string_python(zlib.decompress(base64.urlsafe_b64decode(c)))
+
+    def run(func, items):
+        return lambda: [func(i) for i in items]
+
+    print '{0} tracks, {1} codes each'.format(ns.tracks, ns.codes)
+    python = report('inflate_code_string_python', run(fp.inflate_code_string_python, inflated), ns.number)
+    numpy = report('inflate_code_string', run(fp.inflate_code_string, inflated), ns.number)
+    decode_py = report('decode (python inflate)', run(decode_python, compressed), ns.number)
+    decode = report('decode_code_string', run(fp.decode_code_string, compressed), ns.number)
+    print 'speedup: {0:.1f}x inflate, {1:.1f}x decode, {2:.0f} tracks/s'.format(
+        python / numpy, decode_py / decode, ns.tracks / decode
+    )
+
+
+def solr_bodies(rows, rnd):
+    """ A /hashq response with `rows` candidates, as wt=standard and wt=json. """
+    docs = [{
+        'track_id': 'TR%05d-%d' % (rnd.randrange(100000), rnd.randrange(10)),
+        'artist': 'Artist %d' % rnd.randrange(1000), 'release': 'Release %d' % rnd.randrange(1000),
+        'track': 'Track %d' % rnd.randrange(1000), 'source': 'local',
+        'length': rnd.randrange(60, 600), 'score': rnd.randrange(1000) / 10.0
+    } for _ in xrange(rows)]
+
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>\n<response><lst name="responseHeader">'
+           '<int name="status">0</int><int name="QTime">3</int></lst>'
+           '<result name="response" numFound="{0}" start="0" maxScore="100.0">'.format(rows)]
+    for doc in docs:
+        xml.append('<doc>')
+        for name, value in sorted(doc.items()):
+            tag = {int: 'int', float: 'float'}.get(type(value), 'str')
+            xml.append('<{0} name="{1}">{2}</{0}>'.format(tag, name, escape(str(value))))
+        xml.append('</doc>')
+    xml.append('</result></response>')
+
+    body = {
+        'responseHeader': {'status': 0, 'QTime': 3},
+        'response': {'numFound': rows, 'start': 0, 'maxScore': 100.0, 'docs': docs}
+    }
+    return ''.join(xml), json.dumps(body)
+
+
+def bench_solr_parse(ns):
+    rnd = random.Random(ns.seed)
+    xml, body = solr_bodies(ns.rows, rnd)
+    # never connects, only used to parse
+    conn = solr.SolrConnection('http://localhost:8502/solr/fp')
+
+    def parse_xml():
+        return conn.parse_query_response(StringIO(conn._cleanup(solr.reallyUTF8(xml))), {}, conn)
+
+    def parse_json():
+        return conn.parse_query_response_json(body, {}, conn)
+
+    assert [r['track_id'] for r in parse_xml().results] == [r['track_id'] for r in parse_json().results]
+
+    print '{0} rows, {1} bytes xml, {2} bytes json'.format(ns.rows, len(xml), len(body))
+    standard = report('wt=standard (sax)', parse_xml, ns.number)
+    json_ = report('wt=json ({0})'.format(solr.json.__name__), parse_json, ns.number)
+    print 'speedup: {0:.1f}x'.format(standard / json_)
+
+
+def bench_solr_throughput(ns):
+    """ Ingest and /hashq query throughput of the client against the
+        in-memory Solr stand-in. """
+    rnd = random.Random(ns.seed)
+    server = localsolr.LocalSolrServer(('127.0.0.1', 0))
+    url = server.start()
+
+    docs = [{
+        'track_id': 'TR%05d-%d' % (i // 4, i % 4), 'fp': random_code_string(ns.codes, 2586, rnd),
+        'artist': 'Artist %d' % i, 'release': 'Release', 'track': 'Track', 'length': 240,
+        'codever': '4.12', 'source': 'local', 'import_date': '2015-01-01T00:00:00Z'
+    } for i in xrange(ns.docs)]
+    queries = [excerpt(docs[rnd.randrange(len(docs))]['fp'], 500, 1200, rnd) for _ in xrange(ns.queries)]
+
+    print '{0} documents, {1} codes each, {2} queries'.format(ns.docs, ns.codes, ns.queries)
+    conn = solr.SolrConnection(url)
+    for name, use_json in (('add_many (xml)', False), ('add_many (json)', True)):
+        tic = time.time()
+        conn.add_many(docs, use_json=use_json, batch_size=ns.batch_size)
+        seconds = time.time() - tic
+        conn.commit()
+        print '{0:<30} {1:>10.0f} docs/s'.format(name, ns.docs / seconds)
+
+    fields = ','.join(fp.METADATA_FIELDS)
+    for name, use_json in (('hashq (xml)', False), ('hashq (json)', True)):
+        tic = time.time()
+        for q in queries:
+            conn.query(q, qt='/hashq', rows=30, fields=fields, use_json_parser=use_json)
+        seconds = time.time() - tic
+        print '{0:<30} {1:>10.0f} queries/s'.format(name, ns.queries / seconds)
+    conn.close()
+    server.stop()
+
+
+def serve_tyrant(values):
+    """ A Tokyo Tyrant stand-in which only answers "getlist" (what
+        multi_get sends) from the dict `values`. The responses are cached,
+        so the time is spent in the client. Returns its port and the
+        threads handling the connections, which end once they are closed. """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    handlers = []
+    responses = {}
+
+    def respond(keys):
+        found = [k for k in keys if k in values]
+        out = [struct.pack('>BI', 0, 2 * len(found))]
+        for k in found:
+            out.extend((struct.pack('>I', len(k)), k, struct.pack('>I', len(values[k])), values[k]))
+        return ''.join(out)
+
+    def handle(conn):
+        f = conn.makefile('rb')
+        while True:
+            header = f.read(14)
+            if len(header) < 14:
+                return
+            _, code, func_len, _, num_args = struct.unpack('>BBIII', header)
+            func = f.read(func_len)
+            assert code == pytyrant.C.misc and func == 'getlist'
+            keys = tuple(f.read(struct.unpack('>I', f.read(4))[0]) for _ in xrange(num_args))
+            if keys not in responses:
+                responses[keys] = respond(keys)
+            conn.sendall(responses[keys])
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            conn.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+            handlers.append(thread)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1], handlers
+
+
+def bench_tyrant_multi_get(ns):
+    rnd = random.Random(ns.seed)
+    # decoded code strings of segments, like the keystore holds them
+    values = dict(('TR%05d-0' % i, random_code_string(ns.codes, 2586, rnd)) for i in xrange(ns.keys))
+    keys = sorted(values)
+    port, handlers = serve_tyrant(values)
+    tyrant = pytyrant.PyTyrant.open('127.0.0.1', port)
+    assert tyrant.multi_get(keys) == [values[k] for k in keys]
+
+    print '{0} keys, {1} bytes each'.format(ns.keys, sum(map(len, values.values())) / ns.keys)
+    report('multi_get', lambda: tyrant.multi_get(keys), ns.number)
+    tyrant.close()
+    for thread in handlers:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--number', type=int, default=10)
+
+    subparsers = parser.add_subparsers(dest='subparser_name')
+    am_parser = subparsers.add_parser('actual-matches')
+    am_parser.add_argument('--candidates', type=int, default=30)
+    am_parser.add_argument('--codes', type=int, default=1500)
+    codec_parser = subparsers.add_parser('codec')
+    codec_parser.add_argument('--tracks', type=int, default=100)
+    codec_parser.add_argument('--codes', type=int, default=3000)
+    solr_parser = subparsers.add_parser('solr-parse')
+    solr_parser.add_argument('--rows', type=int, default=30)
+    throughput_parser = subparsers.add_parser('solr-throughput')
+    throughput_parser.add_argument('--docs', type=int, default=2000)
+    throughput_parser.add_argument('--codes', type=int, default=800)
+    throughput_parser.add_argument('--queries', type=int, default=200)
+    throughput_parser.add_argument('--batch-size', type=int, default=500)
+    tyrant_parser = subparsers.add_parser('tyrant-multi-get')
+    tyrant_parser.add_argument('--keys', type=int, default=30)
+    tyrant_parser.add_argument('--codes', type=int, default=1500)
+
+    ns = parser.parse_args()
+
+    commands = {
+        'actual-matches': bench_actual_matches,
+        'codec': bench_codec,
+        'solr-parse': bench_solr_parse,
+        'solr-throughput': bench_solr_throughput,
+        'tyrant-multi-get': bench_tyrant_multi_get,
+    }
+    commands[ns.subparser_name](ns)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,10 @@ import logging
 import argparse
 import re
 from emfas.worker import Emfas, TwitchSegmentProvider2, EmfasException
-from emfas.identification import MoomashAPI, EchoprintServerAPI, IdentificationService
+from emfas.identification import MoomashAPI, EchoprintServerAPI, \
+    IdentificationService, IdentificationException, \
+    CachingIdentificationService
+from emfas.cache import PersistentCache
 
 logger = logging.getLogger('songbot')
 
@@ -66,13 +69,18 @@ class CombinedIdentificationService(IdentificationService):
             if buffer_sizes is not None and buffer_size not in buffer_sizes:
                 continue
 
-            song = service.identify(code, buffer_size)
+            try:
+                song = service.identify(code, buffer_size)
+            except IdentificationException as e:
+                # e.g. rate limited, try the next service
+                logger.info('{0} failed: {1!r}'.format(service, e))
+                continue
             if song and song.score > 50:
                 return song
 
 
 class BaseSongBot(object):
-    def __init__(self, ident, broadcaster, api_key):
+    def __init__(self, ident, broadcaster, api_key, cache=None):
         self.client = EasyClient(ident, 'irc.twitch.tv', port=6667)
 
         self.broadcaster = broadcaster
@@ -87,6 +95,10 @@ class BaseSongBot(object):
             (EchoprintServerAPI(), None),
             (MoomashAPI(api_key), [50, 100,  150])
         )
+        if cache is not None:
+            identification_service = CachingIdentificationService(
+                identification_service, cache
+            )
         self.emfas = Emfas(identification_service, buffer_length=150)
         self._start_emfas()
 
@@ -182,8 +194,8 @@ class BaseSongBot(object):
 
 
 class SongBot(BaseSongBot):
-    def __init__(self, ident, broadcaster, api_key):
-        BaseSongBot.__init__(self, ident, broadcaster, api_key)
+    def __init__(self, ident, broadcaster, api_key, cache=None):
+        BaseSongBot.__init__(self, ident, broadcaster, api_key, cache=cache)
 
     def handle_rate_limited(self, time_since, last_song):
         if last_song is not None:
@@ -204,6 +216,7 @@ def main():
     )
     parser.add_argument('--api-key', required=True)
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--cache', help='Path to a persistent song cache')
     parser.add_argument('username', help='Twitch username')
     parser.add_argument('password', help='Oauth password for twitch chat')
     ns = parser.parse_args()
@@ -219,7 +232,8 @@ def main():
             .setLevel(logging.WARNING)
 
     ident = Identity(ns.username, password=ns.password)
-    songbot = SongBot(ident, ns.channel, ns.api_key)
+    cache = PersistentCache(ns.cache) if ns.cache else None
+    songbot = SongBot(ident, ns.channel, ns.api_key, cache=cache)
 
     def print_song(*args, **kwargs):
         try:
@@ -0,0 +1,79 @@
+import base64
+import random
+import unittest
+import zlib
+
+import emfas.cache
+from emfas.server.lib import fp
+from emfas.server.lib.embedded import EmbeddedFingerPrinter
+from emfas.server.song import Song
+
+
+def compress(s):
+    return base64.urlsafe_b64encode(zlib.compress(s))
+
+
+class DecodeTest(unittest.TestCase):
+    # valid base64 and zlib, but not a code string
+    MALFORMED = [
+        compress('1 2 abc 4 5 6'),
+        compress('1 2 3'),
+        # hex codes with a non hex digit
+        compress('0000a0000bzzzzz00001'),
+        compress('0000a0000b0000'),
+    ]
+
+    def test_decode_code_string(self):
+        for code in self.MALFORMED:
+            self.assertIsNone(fp.decode_code_string(code))
+
+    def test_query(self):
+        store = EmbeddedFingerPrinter()
+        for code in self.MALFORMED + ['1 2 abc 4 5 6']:
+            response = store.best_match_for_query(code)
+            self.assertEqual(response.code, fp.Response.CANNOT_DECODE)
+
+    def test_fingerprint_bands(self):
+        for code in self.MALFORMED + ['1 2 abc 4 5 6']:
+            self.assertIsNone(emfas.cache.fingerprint_bands(code))
+
+    def test_from_echoprint(self):
+        item = {'code': self.MALFORMED[0], 'metadata': {'duration': 10, 'version': 4.12}}
+        self.assertIsNone(Song.from_echoprint(item))
+
+
+class AdaptiveDepthTest(unittest.TestCase):
+    def store(self, depths):
+        """ Two segments of one track, the second far behind the first,
+            the adaptive depths don't rescore it. """
+        rnd = random.Random(1)
+        query = [(rnd.randrange(1 << 20), t) for t in range(200)]
+        noise = [(rnd.randrange(1 << 20), t) for t in range(20)]
+        segments = [
+            ('TRA-0', [(c, t + 100) for c, t in query[:15]] + noise),
+            ('TRA-1', [(c, t + 300) for c, t in query[50:55]] + noise),
+        ]
+
+        store = EmbeddedFingerPrinter(depths=depths)
+        for track_id, pairs in segments:
+            store.ingest({
+                'track_id': track_id, 'length': 60, 'codever': '4.12',
+                'fp': ' '.join('%d %d' % pair for pair in pairs)
+            }, do_commit=False)
+        store.commit()
+        return store, ' '.join('%d %d' % pair for pair in query)
+
+    def test_one_survivor(self):
+        adaptive, query = self.store(depths=(1, 30))
+        full, _ = self.store(depths=(30,))
+
+        response = adaptive.best_match_for_query(query)
+        self.assertEqual(response.depth, 1)
+        expected = full.best_match_for_query(query)
+        self.assertEqual(expected.depth, 2)
+        self.assertEqual(response.code, expected.code)
+        self.assertEqual(response.code, fp.Response.SINGLE_BAD_MATCH)
+
+
+if __name__ == '__main__':
+    unittest.main()